@@ -1,16 +1,25 @@
 # api_server.py - Updated version
-from fastapi import FastAPI, WebSocket, Request, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
-import json
+import logging
+import json_utils
 import asyncio
+import contextlib
 import uuid
 import os
-from chat_logic import ChatSession
-from env_utils import configure_for_environment, is_production, get_port
+from cachetools import TTLCache
+from chat_logic import ChatSession, get_knowledge_manager
+from huggingface_handler import HuggingFaceHandler, close_client
+from llm_handler import close_ollama_client
+from env_utils import configure_for_environment, is_production, get_port, get_workers
+
+# Show handler log messages; uvicorn configures its own loggers
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(name)s - %(message)s")
+logger = logging.getLogger(__name__)
 
 # Get environment configuration
 env_config = configure_for_environment()
@@ -22,6 +31,27 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# User-facing status messages, the language is selected with the LANG_UI environment variable
+UI_STRINGS = {
+    "en": {
+        "model_loaded": "Model loaded successfully, ready to chat!",
+        "model_load_failed": "Model loading failed!",
+        "history_cleared": "Chat history cleared",
+    },
+    "zh": {
+        "model_loaded": "模型已加载完成，可以开始聊天了！",
+        "model_load_failed": "模型加载失败！",
+        "history_cleared": "聊天历史已清除",
+    },
+}
+STRINGS = UI_STRINGS.get(os.environ.get("LANG_UI", "en"), UI_STRINGS["en"])
+
+# Static WebSocket status messages, serialized once
+_MSG_MODEL_LOADED = json_utils.dumps({"type": "status", "content": STRINGS["model_loaded"]})
+_MSG_MODEL_LOAD_FAILED = json_utils.dumps({"type": "status", "content": STRINGS["model_load_failed"]})
+_MSG_HISTORY_CLEARED = json_utils.dumps({"type": "status", "content": STRINGS["history_cleared"]})
+_MSG_CHAT_END = json_utils.dumps({"type": "chat_end"})
+
 # Add CORS middleware to allow cross-origin requests
 app.add_middleware(
     CORSMiddleware,
@@ -34,14 +64,54 @@ app.add_middleware(
 # Mount static files directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Store active chat sessions
-chat_sessions = {}
+# Maximum number of chat sessions kept in memory
+MAX_CHAT_SESSIONS = 256
+# Seconds of inactivity after which a chat session is dropped
+CHAT_SESSION_TTL = 3600
+# Interval in seconds between sweeps for expired chat sessions
+SESSION_SWEEP_INTERVAL = 60
+
+# Store active chat sessions, least recently used sessions are evicted when full.
+# A client that is still connected keeps its own reference and re-adds its session
+# on the next message.
+chat_sessions = TTLCache(maxsize=MAX_CHAT_SESSIONS, ttl=CHAT_SESSION_TTL)
+
+# Knowledge base manager shared with all chat sessions
+_knowledge_manager = get_knowledge_manager()
+
+# HuggingFace handler for upstream health probes, created on first use
+_health_hf_handler = None
+
+async def expire_sessions_periodically():
+    """Periodically drop idle chat sessions so their memory can be released"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        chat_sessions.expire()
+
+@app.on_event("startup")
+async def start_session_sweeper():
+    # Keep a reference so the task isn't garbage collected
+    app.state.session_sweeper = asyncio.create_task(expire_sessions_periodically())
+
+@app.on_event("shutdown")
+async def compact_knowledge_on_shutdown():
+    _knowledge_manager.compact()
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await close_client()
+    await close_ollama_client()
+    if _health_hf_handler is not None:
+        _health_hf_handler.close()
+
+# Homepage content, read once at startup since it doesn't change
+with open("static/index.html", "rb") as f:
+    _INDEX_HTML = f.read()
 
 # Homepage route
 @app.get("/", response_class=HTMLResponse)
 async def get_homepage():
-    with open("static/index.html") as f:
-        return f.read()
+    return HTMLResponse(content=_INDEX_HTML)
 
 # Knowledge API model
 class KnowledgeItem(BaseModel):
@@ -51,22 +121,13 @@ class KnowledgeItem(BaseModel):
 # Get all knowledge
 @app.get("/api/knowledge")
 async def get_knowledge(category: str = None):
-    # Create temporary session to access knowledge base
-    temp_session = ChatSession()
-    knowledge = temp_session.knowledge_manager.get_knowledge(category)
-    
-    return {"status": "success", "data": knowledge}
+    return {"status": "success", "data": _knowledge_manager.get_knowledge(category)}
 
 # Add new knowledge
 @app.post("/api/knowledge")
 async def add_knowledge(item: KnowledgeItem):
-    # Create temporary session to access knowledge base
-    temp_session = ChatSession()
-    knowledge_id = temp_session.knowledge_manager.add_knowledge(item.content, item.category)
-    
-    # Update system prompts for all active sessions
-    for session in chat_sessions.values():
-        session.update_system_prompt()
+    # Sessions pick up the new knowledge version on their next message
+    knowledge_id = _knowledge_manager.add_knowledge(item.content, item.category)
     
     return {"status": "success", "data": {"id": knowledge_id}}
 
@@ -76,50 +137,60 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
     await websocket.accept()
     
     # Create chat session for new client
-    if client_id not in chat_sessions:
-        chat_sessions[client_id] = ChatSession()
-        # Initialize model
-        load_status = chat_sessions[client_id].initialize()
-        await websocket.send_json({
-            "type": "status",
-            "content": "Model loaded successfully, ready to chat!" if load_status else "Model loading failed!"
-        })
+    session = chat_sessions.get(client_id)
+    if session is None:
+        session = chat_sessions[client_id] = ChatSession()
+        # Initialize model in a worker thread so other clients aren't blocked while it loads
+        load_status = await asyncio.to_thread(session.initialize)
+        await websocket.send_text(_MSG_MODEL_LOADED if load_status else _MSG_MODEL_LOAD_FAILED)
     
     try:
         while True:
             # Receive message
             data = await websocket.receive_text()
-            message = json.loads(data)
+            message = json_utils.loads(data)
+            
+            # Mark the session as recently used (re-adds it if it was evicted)
+            chat_sessions[client_id] = session
             
             if message["type"] == "chat":
-                # Get response
+                # Stream the response as it is generated, closing the stream right away
+                # if sending fails so the session records the partial reply
                 category = message.get("category", None)
-                response = chat_sessions[client_id].get_response(message["content"], category)
-                
-                # Send response
-                await websocket.send_json({
-                    "type": "chat",
-                    "content": response
-                })
+                async with contextlib.aclosing(session.astream_response(message["content"], category)) as chunks:
+                    async for chunk in chunks:
+                        await websocket.send_text(json_utils.dumps({
+                            "type": "chat_delta",
+                            "content": chunk
+                        }))
+                await websocket.send_text(_MSG_CHAT_END)
             elif message["type"] == "clear":
                 # Clear history
-                chat_sessions[client_id].clear_history()
-                await websocket.send_json({
-                    "type": "status",
-                    "content": "Chat history cleared"
-                })
+                session.clear_history()
+                await websocket.send_text(_MSG_HISTORY_CLEARED)
+    except WebSocketDisconnect:
+        # The client closed the connection
+        logger.debug("WebSocket client disconnected: %s", client_id)
     except Exception as e:
-        print(f"WebSocket error: {e}")
-    finally:
-        # Clean up resources when client disconnects
-        if client_id in chat_sessions:
-            # Keep chat session until timeout
-            pass
+        logger.warning("WebSocket error: %s", e)
+    # The chat session is kept after the client disconnects so it can reconnect,
+    # it is dropped once idle for CHAT_SESSION_TTL seconds
 
 # Health check endpoint for Render to confirm service is running properly
+# Only probes the HuggingFace API when asked to (?upstream=true), since it is polled frequently
 @app.get("/health")
-async def health_check():
-    return {"status": "healthy", "environment": "production" if is_production() else "local"}
+async def health_check(upstream: bool = False):
+    result = {"status": "healthy", "environment": "production" if is_production() else "local"}
+    
+    if upstream:
+        global _health_hf_handler
+        if _health_hf_handler is None:
+            _health_hf_handler = HuggingFaceHandler()
+        # Probe results are cached by the handler for a short time
+        available, message = await _health_hf_handler.ais_available()
+        result["upstream"] = {"available": available, "message": message}
+    
+    return result
 
 if __name__ == "__main__":
     # Use port from environment configuration
@@ -133,4 +204,16 @@ if __name__ == "__main__":
     else:
         print("Running in local mode with local model")
     
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # uvloop/httptools are used when installed (uvicorn[standard]). An import string is
+    # required to run more than one worker; a single worker is given the app itself, so
+    # this module isn't imported a second time with its own knowledge manager and clients
+    workers = get_workers()
+    uvicorn.run(
+        "api_server:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="auto",
+        http="auto",
+        ws="websockets"
+    )
\ No newline at end of file
@@ -1,12 +1,20 @@
 # chat_logic.py - Updated version
-import json
 import os
-from llm_handler import LLMHandler
-from env_utils import is_production, configure_for_environment
+import logging
+import hashlib
+import collections
+import json_utils
+from llm_handler import get_llm_handler
+from env_utils import is_production, configure_for_environment, load_config
+
+logger = logging.getLogger(__name__)
 
 class KnowledgeManager:
     """Class for managing the knowledge base"""
     
+    # Number of logged additions after which the log is folded into the knowledge file
+    COMPACT_EVERY = 100
+    
     def __init__(self, knowledge_path="knowledge.json"):
         """Initialize the knowledge base manager
         
@@ -14,43 +22,154 @@ class KnowledgeManager:
             knowledge_path: Path to the knowledge base file
         """
         self.knowledge_path = knowledge_path
+        # Append-only log of additions not yet compacted into the knowledge file
+        self.log_path = f"{os.path.splitext(knowledge_path)[0]}.log"
+        self._log_file = None
+        self._log_entries = 0
+        
+        # ID of each stored item keyed by a hash of its category and content, used to skip duplicates
+        self._id_by_hash = {}
+        
         self.knowledge = self._load_knowledge()
+        
+        # Flattened list of all knowledge, rebuilt lazily after changes
+        self._all_cache = None
+        
+        # Incremented on every change so users of formatted knowledge can detect staleness
+        self.version = 0
+        # Formatted prompt text keyed by (category, max_items), valid for the current version
+        self._fmt_cache = {}
     
     def _load_knowledge(self):
-        """Load the knowledge base"""
+        """Load the knowledge base and replay logged additions"""
         try:
-            with open(self.knowledge_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            with open(self.knowledge_path, 'rb') as f:
+                knowledge = json_utils.loads(f.read())
+        except (FileNotFoundError, json_utils.JSONDecodeError):
             # If the file doesn't exist or has incorrect format, create an empty knowledge base
-            return {"general": [], "categories": {}}
+            knowledge = {"general": [], "categories": {}}
+        
+        # Index existing items
+        for i, item in enumerate(knowledge["general"]):
+            self._id_by_hash.setdefault(self._hash_item(item), f"general_{i}")
+        for category, items in knowledge["categories"].items():
+            for i, item in enumerate(items):
+                self._id_by_hash.setdefault(self._hash_item(item, category), f"{category}_{i}")
+        
+        try:
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json_utils.loads(line)
+                    except json_utils.JSONDecodeError:
+                        # Skip a partially written last line
+                        continue
+                    self._add_item(knowledge, entry["content"], entry.get("category"))
+                    self._log_entries += 1
+        except FileNotFoundError:
+            pass
+        
+        return knowledge
     
-    def save_knowledge(self):
-        """Save the knowledge base"""
-        with open(self.knowledge_path, 'w', encoding='utf-8') as f:
-            json.dump(self.knowledge, f, ensure_ascii=False, indent=4)
+    @staticmethod
+    def _hash_item(content, category=None):
+        """Hash a knowledge item, ignoring differences in whitespace"""
+        normalized = " ".join(content.split())
+        return hashlib.blake2b(f"{category or ''}\0{normalized}".encode('utf-8'), digest_size=16).hexdigest()
     
-    def add_knowledge(self, content, category=None):
-        """Add knowledge
+    def _add_item(self, knowledge, content, category=None):
+        """Add an item to a knowledge dict unless the category already contains it
         
         Args:
+            knowledge: Knowledge dict to modify
             content: Knowledge content
             category: Knowledge category, if None it will be added to general knowledge
         
         Returns:
-            ID of the successfully added knowledge
+            (knowledge_id, added), the ID of the existing item if it was a duplicate
+        """
+        item_hash = self._hash_item(content, category)
+        knowledge_id = self._id_by_hash.get(item_hash)
+        if knowledge_id is not None:
+            return knowledge_id, False
+        
+        knowledge_id = self._id_by_hash[item_hash] = self._append(knowledge, content, category)
+        return knowledge_id, True
+    
+    @staticmethod
+    def _append(knowledge, content, category=None):
+        """Append an item to a knowledge dict
+        
+        Args:
+            knowledge: Knowledge dict to modify
+            content: Knowledge content
+            category: Knowledge category, if None it will be added to general knowledge
+        
+        Returns:
+            ID of the added knowledge
         """
         if category:
-            if category not in self.knowledge["categories"]:
-                self.knowledge["categories"][category] = []
+            if category not in knowledge["categories"]:
+                knowledge["categories"][category] = []
             
-            self.knowledge["categories"][category].append(content)
-            knowledge_id = f"{category}_{len(self.knowledge['categories'][category]) - 1}"
+            knowledge["categories"][category].append(content)
+            return f"{category}_{len(knowledge['categories'][category]) - 1}"
         else:
-            self.knowledge["general"].append(content)
-            knowledge_id = f"general_{len(self.knowledge['general']) - 1}"
+            knowledge["general"].append(content)
+            return f"general_{len(knowledge['general']) - 1}"
+    
+    def save_knowledge(self):
+        """Save the knowledge base"""
+        # Write to a temporary file first so the knowledge base is never left half-written
+        tmp_path = f"{self.knowledge_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json_utils.dumps_bytes(self.knowledge, indent=True))
+        os.replace(tmp_path, self.knowledge_path)
+    
+    def compact(self):
+        """Fold logged additions into the knowledge file and empty the log
+        
+        Returns:
+            True if the knowledge base was written to disk
+        """
+        if not self._log_entries:
+            return False
         
         self.save_knowledge()
+        if self._log_file is None:
+            self._log_file = open(self.log_path, 'ab')
+        self._log_file.seek(0)
+        self._log_file.truncate()
+        self._log_entries = 0
+        return True
+    
+    def add_knowledge(self, content, category=None):
+        """Add knowledge
+        
+        Args:
+            content: Knowledge content
+            category: Knowledge category, if None it will be added to general knowledge
+        
+        Returns:
+            ID of the successfully added knowledge, or of the existing identical item
+        """
+        knowledge_id, added = self._add_item(self.knowledge, content, category)
+        if not added:
+            # Duplicate content, nothing to store
+            return knowledge_id
+        
+        # Record the addition as one log line instead of rewriting the whole file
+        if self._log_file is None:
+            self._log_file = open(self.log_path, 'ab')
+        self._log_file.write(json_utils.dumps_bytes({"category": category, "content": content}) + b"\n")
+        self._log_file.flush()
+        self._log_entries += 1
+        if self._log_entries >= self.COMPACT_EVERY:
+            self.compact()
+        
+        self._all_cache = None
+        self._fmt_cache.clear()
+        self.version += 1
         return knowledge_id
     
     def get_knowledge(self, category=None):
@@ -68,10 +187,12 @@ class KnowledgeManager:
             return []
         else:
             # Return all knowledge
-            all_knowledge = self.knowledge["general"].copy()
-            for category_knowledge in self.knowledge["categories"].values():
-                all_knowledge.extend(category_knowledge)
-            return all_knowledge
+            if self._all_cache is None:
+                all_knowledge = self.knowledge["general"].copy()
+                for category_knowledge in self.knowledge["categories"].values():
+                    all_knowledge.extend(category_knowledge)
+                self._all_cache = all_knowledge
+            return self._all_cache
     
     def format_for_prompt(self, category=None, max_items=5):
         """Format knowledge for prompt
@@ -83,6 +204,11 @@ class KnowledgeManager:
         Returns:
             Formatted knowledge text
         """
+        cache_key = (category, max_items)
+        formatted = self._fmt_cache.get(cache_key)
+        if formatted is not None:
+            return formatted
+        
         knowledge_items = self.get_knowledge(category)
         
         # If there's too much knowledge, only take the first max_items
@@ -90,14 +216,31 @@ class KnowledgeManager:
             knowledge_items = knowledge_items[:max_items]
         
         if not knowledge_items:
-            return ""
-        
-        formatted = "Here is important information you should know:\n\n"
-        for i, item in enumerate(knowledge_items, 1):
-            formatted += f"{i}. {item}\n"
+            formatted = ""
+        else:
+            items_text = "\n".join(f"{i}. {item}" for i, item in enumerate(knowledge_items, 1))
+            formatted = f"Here is important information you should know:\n\n{items_text}\n"
         
+        self._fmt_cache[cache_key] = formatted
         return formatted
 
+# Knowledge base managers shared by all sessions, keyed by knowledge file path
+_SHARED_KM = {}
+
+def get_knowledge_manager(knowledge_path="knowledge.json"):
+    """Get the shared knowledge base manager for a knowledge file
+    
+    Args:
+        knowledge_path: Path to the knowledge base file
+    
+    Returns:
+        KnowledgeManager instance shared across sessions
+    """
+    knowledge_manager = _SHARED_KM.get(knowledge_path)
+    if knowledge_manager is None:
+        knowledge_manager = _SHARED_KM[knowledge_path] = KnowledgeManager(knowledge_path)
+    return knowledge_manager
+
 class ChatSession:
     """Class for managing chat sessions"""
     
@@ -112,25 +255,33 @@ class ChatSession:
         self.env_config = configure_for_environment()
         
         # Load configuration
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
+        self.config = load_config(config_path)
             
         # If in production environment, update configuration to use HuggingFace API
+        # (copy the model section rather than modifying the shared cached config)
         if is_production():
-            self.config['model']['use_huggingface_api'] = True
-            self.config['model']['use_ollama'] = False
-            self.config['model']['use_llama_cpp'] = False
-            print("Production environment detected, using HuggingFace API")
+            self.config = {**self.config, 'model': {
+                **self.config['model'],
+                'use_huggingface_api': True,
+                'use_ollama': False,
+                'use_llama_cpp': False,
+            }}
+            logger.info("Production environment detected, using HuggingFace API")
         
-        # Initialize LLM handler
-        self.llm_handler = LLMHandler(config_path)
+        # LLM handler shared by all sessions, so a local model is only loaded once
+        self.llm_handler = get_llm_handler(config_path)
         
-        # Initialize knowledge base manager
-        self.knowledge_manager = KnowledgeManager(knowledge_path)
+        # Use the shared knowledge base manager
+        self.knowledge_manager = get_knowledge_manager(knowledge_path)
         
-        # Chat history
-        self.chat_history = []
+        # Chat history, the system prompt is kept apart so trimming never drops it
         self.max_history = self.config['chat']['max_history']
+        self._system_msg = None
+        self._history = collections.deque(maxlen=self.max_history)
+        
+        # Knowledge version and category the system prompt was last built from
+        self._last_version = None
+        self._last_category = None
         
         # Add system prompt
         self.update_system_prompt()
@@ -141,6 +292,13 @@ class ChatSession:
         Args:
             category: Knowledge category, if None it will use all knowledge
         """
+        has_system_prompt = self._system_msg is not None
+        
+        # Nothing to do if the prompt was already built from the same knowledge
+        prompt_key = (self.knowledge_manager.version, category)
+        if has_system_prompt and (self._last_version, self._last_category) == prompt_key:
+            return
+        
         base_prompt = self.config['chat']['system_prompt']
         knowledge_text = self.knowledge_manager.format_for_prompt(category)
         
@@ -149,33 +307,55 @@ class ChatSession:
         else:
             system_prompt = base_prompt
         
-        # Update system prompt in chat history
-        if self.chat_history and self.chat_history[0]["role"] == "system":
-            self.chat_history[0]["content"] = system_prompt
+        # Update system prompt in chat history (unless the new knowledge didn't change it)
+        if has_system_prompt:
+            if self._system_msg["content"] != system_prompt:
+                self._system_msg["content"] = system_prompt
         else:
-            self.chat_history.insert(0, {"role": "system", "content": system_prompt})
+            self._system_msg = {"role": "system", "content": system_prompt}
+        
+        self._last_version = self.knowledge_manager.version
+        self._last_category = category
+    
+    @property
+    def chat_history(self):
+        """Chat history as a list, starting with the system prompt"""
+        if self._system_msg is None:
+            return list(self._history)
+        return [self._system_msg, *self._history]
     
     def initialize(self):
         """Initialize chat session, load model"""
         return self.llm_handler.load_model()
     
+    @property
+    def precision(self):
+        """Precision of the loaded local model, None if it isn't known"""
+        return self.llm_handler.precision
+    
     def add_message(self, role, content):
         """Add message to history
         
         Args:
-            role: Role, 'user' or 'assistant'
+            role: Role, 'user' or 'assistant' ('system' replaces the system prompt)
             content: Message content
         """
-        self.chat_history.append({"role": role, "content": content})
+        if role == "system":
+            self._system_msg = {"role": role, "content": content}
+        else:
+            # The deque drops the oldest messages once max_history is reached
+            self._history.append({"role": role, "content": content})
+    
+    def _refresh_system_prompt(self, category=None):
+        """Rebuild the system prompt if it is out of date
         
-        # If history exceeds maximum length, delete the oldest messages
-        # but keep the system prompt
-        if len(self.chat_history) > self.max_history + 1:
-            # If the first message is a system prompt, keep it
-            if self.chat_history[0]["role"] == "system":
-                self.chat_history = [self.chat_history[0]] + self.chat_history[-(self.max_history):]
-            else:
-                self.chat_history = self.chat_history[-self.max_history:]
+        Args:
+            category: Knowledge category to use, if None the previous category is kept
+        """
+        if not category:
+            category = self._last_category
+        # update_system_prompt returns early when nothing changed
+        self.update_system_prompt(category)
     
     def get_response(self, user_input, category=None):
         """Get response to user input
@@ -187,9 +367,8 @@ class ChatSession:
         Returns:
             Assistant's response text
         """
-        # If a category is specified, update the system prompt
-        if category:
-            self.update_system_prompt(category)
+        # Refresh the system prompt if the category or the knowledge base changed
+        self._refresh_system_prompt(category)
         
         # Add user message to history
         self.add_message("user", user_input)
@@ -202,13 +381,92 @@ class ChatSession:
         
         return response
     
+    def stream_response(self, user_input, category=None, stop_event=None):
+        """Get response to user input, yielding text chunks as they are generated
+        
+        Args:
+            user_input: User input text
+            category: Knowledge category to use, if None it will use all knowledge
+            stop_event: Event that, once set, ends the response before the next chunk
+            
+        Yields:
+            Pieces of the assistant's response text
+        """
+        # Refresh the system prompt if the category or the knowledge base changed
+        self._refresh_system_prompt(category)
+        
+        # Add user message to history
+        self.add_message("user", user_input)
+        
+        # Stream response
+        chunks = []
+        try:
+            for chunk in self.llm_handler.generate_response_stream(self.chat_history):
+                chunks.append(chunk)
+                yield chunk
+                if stop_event is not None and stop_event.is_set():
+                    break
+        finally:
+            # Add assistant response to history, also the part generated before the caller stopped reading
+            if chunks:
+                self.add_message("assistant", "".join(chunks))
+    
+    async def aget_response(self, user_input, category=None):
+        """Get response to user input without blocking the event loop
+        
+        Args:
+            user_input: User input text
+            category: Knowledge category to use, if None it will use all knowledge
+            
+        Returns:
+            Assistant's response text
+        """
+        # Refresh the system prompt if the category or the knowledge base changed
+        self._refresh_system_prompt(category)
+        
+        # Add user message to history
+        self.add_message("user", user_input)
+        
+        # Get response
+        response = await self.llm_handler.agenerate_response(self.chat_history)
+        
+        # Add assistant response to history
+        self.add_message("assistant", response)
+        
+        return response
+    
+    async def astream_response(self, user_input, category=None):
+        """Get response to user input, yielding text chunks as they are generated
+        
+        Args:
+            user_input: User input text
+            category: Knowledge category to use, if None it will use all knowledge
+            
+        Yields:
+            Pieces of the assistant's response text
+        """
+        # Refresh the system prompt if the category or the knowledge base changed
+        self._refresh_system_prompt(category)
+        
+        # Add user message to history
+        self.add_message("user", user_input)
+        
+        # Stream response
+        chunks = []
+        try:
+            async for chunk in self.llm_handler.astream_response(self.chat_history):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            # Add assistant response to history, also the part generated before the
+            # client disconnected or the task was cancelled
+            if chunks:
+                self.add_message("assistant", "".join(chunks))
+    
     def clear_history(self):
         """Clear chat history"""
         # Keep system prompt
-        if self.chat_history and self.chat_history[0]["role"] == "system":
-            system_prompt = self.chat_history[0]["content"]
-            self.chat_history = [{"role": "system", "content": system_prompt}]
-        else:
-            self.chat_history = []
+        self._history.clear()
+        if self._system_msg is None:
             # Re-add system prompt
-            self.update_system_prompt()
\ No newline at end of file
+            self.update_system_prompt()
@@ -0,0 +1,126 @@
+import queue
+import multiprocessing
+from chat_logic import ChatSession
+
+def _serve_chat_session(config_path, requests, responses, stop):
+    """Run a chat session, answering requests until None is received (child process)"""
+    session = ChatSession(config_path)
+    for command, *args in iter(requests.get, None):
+        try:
+            if command == "initialize":
+                success = session.initialize()
+                responses.put(("result", success, session.precision))
+            elif command == "stream":
+                for chunk in session.stream_response(*args, stop_event=stop):
+                    responses.put(("chunk", chunk))
+                responses.put(("end",))
+            elif command == "clear":
+                session.clear_history()
+        except Exception as e:
+            responses.put(("error", str(e)))
+
+class ChatSessionProcess:
+    """Chat session running in a child process
+    
+    Model inference then never holds the caller's GIL, so the desktop UI stays responsive
+    while a local model generates. Offers the ChatSession methods used by the UI; requests
+    are handled in the order they are sent.
+    """
+    
+    # Seconds between checks that the child process is still running, and for a
+    # stop request, while waiting for it
+    POLL_INTERVAL = 0.1
+    
+    def __init__(self, config_path="config.json"):
+        """Start the chat session process
+        
+        Args:
+            config_path: Path to the configuration file
+        """
+        # Spawn rather than fork, the parent runs Tk and may have threads running
+        context = multiprocessing.get_context("spawn")
+        self._requests = context.Queue()
+        self._responses = context.Queue()
+        # Set to stop the response being generated
+        self._stop = context.Event()
+        self._process = context.Process(
+            target=_serve_chat_session,
+            args=(config_path, self._requests, self._responses, self._stop),
+            daemon=True
+        )
+        self._process.start()
+        self.precision = None
+    
+    def _receive(self, stop_event=None):
+        """Wait for the next message from the chat session process
+        
+        Args:
+            stop_event: Event that, once set, is passed on to stop the child's response
+        """
+        while True:
+            try:
+                message = self._responses.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if stop_event is not None and stop_event.is_set():
+                    self._stop.set()
+                if not self._process.is_alive():
+                    raise RuntimeError("Chat session process exited")
+                continue
+            if message[0] == "error":
+                raise RuntimeError(message[1])
+            return message
+    
+    def initialize(self):
+        """Initialize chat session, load model"""
+        self._requests.put(("initialize",))
+        _, success, self.precision = self._receive()
+        return success
+    
+    def stream_response(self, user_input, category=None, stop_event=None):
+        """Get response to user input, yielding text chunks as they are generated
+        
+        The child ends the response before its next chunk once stop_event is set; every
+        chunk it generated is still yielded, matching what it records in the history.
+        
+        Args:
+            user_input: User input text
+            category: Knowledge category to use, if None it will use all knowledge
+            stop_event: Event that, once set, ends the response before the next chunk
+            
+        Yields:
+            Pieces of the assistant's response text
+        """
+        # A stop left over from an earlier response doesn't apply to this one
+        self._stop.clear()
+        self._requests.put(("stream", user_input, category))
+        finished = False
+        try:
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    self._stop.set()
+                message = self._receive(stop_event)
+                if message[0] == "end":
+                    finished = True
+                    return
+                yield message[1]
+        except RuntimeError:
+            finished = True
+            raise
+        finally:
+            if not finished:
+                # Closed early: stop the child and skip the rest of its response
+                self._stop.set()
+                try:
+                    while self._receive()[0] != "end":
+                        pass
+                finally:
+                    self._stop.clear()
+    
+    def clear_history(self):
+        """Clear chat history"""
+        self._requests.put(("clear",))
+    
+    def close(self):
+        """Stop the chat session process"""
+        self._requests.put(None)
+        self._process.join(timeout=5)
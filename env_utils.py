@@ -1,16 +1,77 @@
 import os
+import functools
 from dotenv import load_dotenv
+import json_utils
 
+# Load environment variables from .env file if it exists
+load_dotenv()
+
+# Settings used when the configuration file leaves them out or doesn't exist
+DEFAULT_CONFIG = {
+    "model": {
+        "name": "meta-llama/Meta-Llama-3.1-8B-Instruct",
+        "device": "auto",
+        "dtype": "bfloat16",
+        "n_batch": 512
+    },
+    "ui": {
+        "title": "Simple Local Chatbot",
+        "width": 800,
+        "height": 600,
+        "theme": "light"
+    },
+    "chat": {
+        "max_history": 10,
+        "system_prompt": "You are a helpful AI assistant.",
+        "max_new_tokens": 256
+    }
+}
+
+def load_config(path="config.json"):
+    """
+    Load the configuration file, parsing it again only when it changes.
+    
+    Settings missing from the file are taken from DEFAULT_CONFIG. The returned
+    dict is shared between callers and must not be modified.
+    
+    Args:
+        path: Path to the configuration file
+    
+    Returns:
+        dict: Parsed configuration
+    """
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    return _load_config(path, mtime)
+
+@functools.lru_cache(maxsize=8)
+def _load_config(path, mtime):
+    """Parse the configuration file, cached by path and modification time"""
+    if mtime is None:
+        return _merge_config(DEFAULT_CONFIG, {})
+    with open(path, 'rb') as f:
+        return _merge_config(DEFAULT_CONFIG, json_utils.loads(f.read()))
+
+def _merge_config(defaults, overrides):
+    """Merge configuration settings into a copy of the defaults, section by section"""
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(defaults.get(key), dict):
+            merged[key] = _merge_config(defaults[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+@functools.lru_cache(maxsize=None)
 def is_production():
     """
     Determine if the application is running in production environment.
     
+    The environment is checked once, it doesn't change while the process runs.
+    
     Returns:
         bool: True if running in production, False otherwise
     """
-    # Load environment variables from .env file if it exists
-    load_dotenv()
-    
     # Check if running on Render
     is_render = os.environ.get('RENDER', '').lower() == 'true'
     
@@ -35,6 +96,25 @@ def get_port():
     # Default local port
     return 8000
 
+def get_workers():
+    """
+    Get the number of server worker processes.
+    
+    Chat sessions and the knowledge base live in process memory, and each
+    worker compacts knowledge.json from its own copy, so more than one worker
+    is opt-in with CHATBOT_WORKERS. WEB_CONCURRENCY is not used since PaaS
+    hosts set it without the application asking for it.
+    
+    Returns:
+        int: Number of worker processes
+    """
+    workers = os.environ.get('CHATBOT_WORKERS')
+    if workers:
+        return max(1, int(workers))
+    
+    # Default to a single process
+    return 1
+
 def configure_for_environment():
     """
     Configure application settings based on the environment.
@@ -42,9 +122,6 @@ def configure_for_environment():
     Returns:
         dict: Configuration settings
     """
-    # Load environment variables
-    load_dotenv()
-    
     # Check environment
     production = is_production()
     
@@ -0,0 +1,29 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def create_session(headers=None, pool_connections=4, pool_maxsize=16):
+    """
+    Create a requests session that keeps connections alive and reuses them.
+
+    Connection failures and 502/503/504 responses are retried twice with backoff.
+
+    Args:
+        headers: Headers sent with every request
+        pool_connections: Number of hosts to keep connection pools for
+        pool_maxsize: Maximum number of connections kept per host
+
+    Returns:
+        requests.Session: Configured session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
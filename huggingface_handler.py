@@ -1,24 +1,195 @@
-import json
 import os
-import requests
-import traceback
-from dotenv import load_dotenv
+import re
+import asyncio
+import hashlib
+import threading
+import time
+import httpx
+import logging
+from cachetools import LRUCache
+import json_utils
+from env_utils import load_config
+from http_utils import create_session
+
+logger = logging.getLogger(__name__)
+
+# Echoed prompt up to and including the first [/INST] marker
+_PROMPT_ARTIFACT = re.compile(r"\A.*?\[/INST\]\s*", re.DOTALL)
+
+# Shared async HTTP client, keeps connections to the Inference API alive across requests
+_client = httpx.AsyncClient(
+    http2=True,
+    timeout=60,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+)
+
+async def close_client():
+    """Close the shared async HTTP client"""
+    for batcher in _batchers.values():
+        batcher.close()
+    _batchers.clear()
+    await _client.aclose()
+
+class RequestBatcher:
+    """Sends concurrent requests to one endpoint as a single list-input request
+    
+    Requests arriving within max_batch_delay seconds of the first one, up to
+    max_batch_size of them, share one HTTPS round trip and one model step.
+    If the endpoint doesn't accept list inputs, the batch is sent one by one.
+    """
+    
+    def __init__(self, handler, api_url, parameters, max_batch_size=8, max_batch_delay=0.02):
+        """Initialize the batcher
+        
+        Args:
+            handler: HuggingFaceHandler used for headers and response parsing
+            api_url: Text-generation endpoint
+            parameters: Generation parameters shared by every request in a batch
+            max_batch_size: Maximum number of inputs sent together
+            max_batch_delay: Seconds to wait for more requests after the first one
+        """
+        self.handler = handler
+        self.api_url = api_url
+        self.parameters = parameters
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        
+        # Created on first use so they belong to the server's event loop
+        self._queue = None
+        self._task = None
+        # Batches being sent, kept so the tasks aren't garbage collected
+        self._sending = set()
+        # Set to False once the endpoint rejects list inputs
+        self._accepts_lists = True
+    
+    async def submit(self, prompt):
+        """Queue a prompt and wait for its generated text
+        
+        Args:
+            prompt: Formatted prompt text
+            
+        Returns:
+            (text, success), text is the generated response or an error message
+        """
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._collect())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+    
+    def close(self):
+        """Stop collecting requests"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    async def _collect(self):
+        """Group queued prompts into batches"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_batch_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Send in the background so the next batch can be collected meanwhile
+            task = asyncio.create_task(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+    
+    async def _post(self, inputs):
+        """Send one request and return (status_code, content)"""
+        body = json_utils.dumps_bytes({"inputs": inputs, "parameters": self.parameters})
+        response = await _client.post(self.api_url, headers=self.handler._headers, content=body)
+        return response.status_code, response.content
+    
+    async def _post_single(self, prompt):
+        """Send one prompt on its own and parse the response"""
+        status_code, content = await self._post(prompt)
+        return self.handler._parse_response(status_code, content)
+    
+    async def _send(self, batch):
+        """Send a batch and resolve the futures of its requests"""
+        prompts = [prompt for prompt, _ in batch]
+        try:
+            results = None
+            if len(prompts) > 1 and self._accepts_lists:
+                status_code, content = await self._post(prompts)
+                if status_code in (400, 422):
+                    # Don't try list inputs again on this endpoint
+                    self._accepts_lists = False
+                elif status_code == 200:
+                    decoded = json_utils.loads(content)
+                    # One result per input, in input order
+                    if isinstance(decoded, list) and len(decoded) == len(prompts):
+                        results = [self.handler._parse_result(item) for item in decoded]
+            
+            if results is None:
+                results = await asyncio.gather(*(self._post_single(prompt) for prompt in prompts))
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+# Request batchers per endpoint and generation parameters
+_batchers = {}
 
 class HuggingFaceHandler:
     """Class for handling the HuggingFace Inference API"""
     
+    # Responses to deterministic requests, keyed by a hash of the request, shared by all handlers
+    _response_cache = LRUCache(maxsize=1024)
+    _response_cache_lock = threading.Lock()
+    
+    # Chat prompt formats: text before the conversation, a template per message role
+    # with the message as {content}, text that asks the model for its reply, and text
+    # that ends the reply
+    LLAMA3_CHAT_FORMAT = {
+        "prefix": "<|begin_of_text|>",
+        "turns": {
+            role: "<|start_header_id|>" + role + "<|end_header_id|>\n\n{content}<|eot_id|>"
+            for role in ("system", "user", "assistant")
+        },
+        "generation_prompt": "<|start_header_id|>assistant<|end_header_id|>\n\n",
+        "stop": ["<|eot_id|>", "<|end_of_text|>"],
+    }
+    INST_CHAT_FORMAT = {
+        "prefix": "",
+        "turns": {
+            "system": "<s>[INST] {content} [/INST]</s>\n",
+            "user": "<s>[INST] {content} [/INST]",
+            "assistant": " {content}</s>\n",
+        },
+        "generation_prompt": "",
+        "stop": ["</s>"],
+    }
+    
+    # Seconds an availability probe result is reused
+    AVAILABILITY_TTL = 60
+    # Last availability probe result per API URL, as (timestamp, (available, message))
+    _avail_cache = {}
+    
     def __init__(self, config_path="config.json"):
         """Initialize the HuggingFace handler
         
         Args:
             config_path: Path to the configuration file
         """
-        # Load environment variables
-        load_dotenv()
-        
-        # Load configuration
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
+        # Load configuration (environment variables are loaded by env_utils)
+        self.config = load_config(config_path)
         
         # Get API configuration
         self.api_key = os.getenv("HUGGINGFACE_API_KEY")
@@ -41,122 +212,467 @@ class HuggingFaceHandler:
             self.top_p = 0.9
             self.repetition_penalty = 1.1
         
+        # Prompt format matching the model's chat template
+        self._chat_format = self._select_chat_format(self.model_name)
+        
+        # Tokens the model can attend to, the API drops the oldest prompt tokens beyond
+        # what fits next to the generated ones
+        self.context_size = self.config.get('huggingface', {}).get(
+            'context_size', self.config['model'].get('context_size', 4096))
+        
+        # Sampling is disabled with a temperature of 0, which makes responses cacheable
+        self.do_sample = self.temperature > 0
+        
         self.api_url = f"https://api-inference.huggingface.co/models/{self.model_name}"
         
+        # Concurrent async requests are batched when batch_max_size is above 1
+        hf_config = self.config.get('huggingface', {})
+        self.batch_max_size = hf_config.get('batch_max_size', 1)
+        self.batch_max_delay_ms = hf_config.get('batch_max_delay_ms', 20)
+        
         # System prompt
         self.system_prompt = self.config['chat']['system_prompt']
+        
+        # Request headers, and a pooled session so synchronous calls reuse connections
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        self._session = create_session(self._headers)
     
-    def is_available(self):
-        """Check if HuggingFace API is available"""
+    def close(self):
+        """Close the pooled session used for synchronous calls"""
+        self._session.close()
+    
+    def _check_api_key(self):
+        """Check that the API key is set
+        
+        Returns:
+            (False, message) if the key is missing, otherwise None
+        """
         if not self.api_key:
             return False, "HuggingFace API key not set, please set HUGGINGFACE_API_KEY in the .env file"
+        return None
+    
+    def _availability_from_status(self, status_code):
+        """Interpret the status code of an availability probe"""
+        if status_code == 200:
+            return True, "HuggingFace API is available"
+        elif status_code == 401:
+            return False, "Invalid HuggingFace API key"
+        elif status_code == 404:
+            return False, f"Model {self.model_name} not found"
+        else:
+            return False, f"HuggingFace API returned status code {status_code}"
+    
+    def _get_cached_availability(self):
+        """Get a recent availability probe result, or None"""
+        cached = self._avail_cache.get(self.api_url)
+        if cached and time.monotonic() - cached[0] < self.AVAILABILITY_TTL:
+            return cached[1]
+        return None
+    
+    def _set_cached_availability(self, result):
+        """Remember an availability probe result"""
+        self._avail_cache[self.api_url] = (time.monotonic(), result)
+        return result
+    
+    def is_available(self):
+        """Check if HuggingFace API is available
+        
+        Generation calls are not probed first, their own error responses are reported
+        instead. A recent generation or probe result is reused without a request.
+        """
+        missing_key = self._check_api_key()
+        if missing_key:
+            return missing_key
+        
+        cached = self._get_cached_availability()
+        if cached:
+            return cached
         
         try:
             # Test API connection
-            headers = {"Authorization": f"Bearer {self.api_key}"}
-            response = requests.head(self.api_url, headers=headers)
-            
-            if response.status_code == 200:
-                return True, "HuggingFace API is available"
-            elif response.status_code == 401:
-                return False, "Invalid HuggingFace API key"
-            elif response.status_code == 404:
-                return False, f"Model {self.model_name} not found"
-            else:
-                return False, f"HuggingFace API returned status code {response.status_code}"
+            response = self._session.head(self.api_url, timeout=(3.05, 60))
+            return self._set_cached_availability(self._availability_from_status(response.status_code))
         except Exception as e:
             return False, f"Error connecting to HuggingFace API: {str(e)}"
     
-    def generate_response(self, messages):
-        """Generate a response
+    async def ais_available(self):
+        """Check if HuggingFace API is available, without blocking the event loop"""
+        missing_key = self._check_api_key()
+        if missing_key:
+            return missing_key
+        
+        cached = self._get_cached_availability()
+        if cached:
+            return cached
+        
+        try:
+            # Test API connection
+            response = await _client.head(self.api_url, headers=self._headers)
+            return self._set_cached_availability(self._availability_from_status(response.status_code))
+        except Exception as e:
+            return False, f"Error connecting to HuggingFace API: {str(e)}"
+    
+    def _select_chat_format(self, model_name):
+        """Get the prompt format matching a model's chat template
         
         Args:
-            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            model_name: HuggingFace model ID
             
         Returns:
-            Generated response text
+            Chat format, see LLAMA3_CHAT_FORMAT
         """
-        # Ensure system prompt is at the beginning of the message list
-        if not messages or messages[0].get("role") != "system":
-            messages = [{"role": "system", "content": self.system_prompt}] + messages
-        
-        # Construct request headers
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # Get only the last few messages to avoid context overflow
-        # For Llama models, we'll use just the system prompt and the last user message
-        last_user_msg = None
-        for msg in reversed(messages):
-            if msg["role"] == "user":
-                last_user_msg = msg["content"]
-                break
+        name = model_name.lower()
+        if "llama-3" in name or "llama3" in name:
+            return self.LLAMA3_CHAT_FORMAT
+        # Llama 2 and Mistral style models
+        return self.INST_CHAT_FORMAT
+    
+    def _build_request(self, messages):
+        """Build the request body for the text-generation API
         
-        if not last_user_msg:
-            return "No user message found to respond to."
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            
+        Returns:
+            Request payload, or None if there is no user message to respond to
+        """
+        # The reply is to the last user message, normally the last message, so search from the end
+        last_user_index = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"), None)
+        if last_user_index is None or not messages[last_user_index]["content"]:
+            return None
         
-        # Create a simple prompt with just the system message and last user query
-        system_msg = messages[0]["content"]
-        prompt = f"<s>[INST] {system_msg} [/INST]</s>\n<s>[INST] {last_user_msg} [/INST]"
+        # Render the conversation up to that message, starting with the system prompt
+        turns = self._chat_format["turns"]
+        parts = [self._chat_format["prefix"]]
+        if messages[0].get("role") != "system":
+            parts.append(turns["system"].format(content=self.system_prompt))
+        for msg in messages[:last_user_index + 1]:
+            template = turns.get(msg["role"])
+            if template:
+                parts.append(template.format(content=msg["content"]))
+        parts.append(self._chat_format["generation_prompt"])
+        prompt = "".join(parts)
         
         # Construct request body for text-generation API
+        parameters = {
+            "max_new_tokens": self.max_new_tokens,
+            "repetition_penalty": self.repetition_penalty,
+            "do_sample": self.do_sample,
+            "return_full_text": False,
+            "stop": self._chat_format["stop"],
+            # Keep the most recent prompt tokens if the conversation outgrows the context
+            "truncate": self.context_size - self.max_new_tokens
+        }
+        if self.do_sample:
+            parameters["temperature"] = self.temperature
+            parameters["top_p"] = self.top_p
         payload = {
             "inputs": prompt,
-            "parameters": {
-                "max_new_tokens": self.max_new_tokens,
-                "temperature": self.temperature,
-                "top_p": self.top_p,
-                "repetition_penalty": self.repetition_penalty,
-                "do_sample": True,
-                "return_full_text": False
-            }
+            "parameters": parameters
         }
         
+        return payload
+    
+    def _get_batcher(self, parameters):
+        """Get the shared batcher for this endpoint and generation parameters"""
+        key = (self.api_url, json_utils.dumps(parameters))
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = _batchers[key] = RequestBatcher(
+                self,
+                self.api_url,
+                parameters,
+                max_batch_size=self.batch_max_size,
+                max_batch_delay=self.batch_max_delay_ms / 1000
+            )
+        return batcher
+    
+    def _cache_key(self, body):
+        """Get the response cache key for a request body
+        
+        Args:
+            body: Encoded request body
+            
+        Returns:
+            Cache key, or None if responses to the request must not be cached
+        """
+        # Sampled responses differ between calls, only deterministic ones are cached
+        if self.do_sample:
+            return None
+        return hashlib.blake2b(self.api_url.encode('utf-8') + b"\0" + body, digest_size=16).hexdigest()
+    
+    def _get_cached(self, cache_key):
+        """Get a cached response, or None"""
+        if cache_key is None:
+            return None
+        with self._response_cache_lock:
+            return self._response_cache.get(cache_key)
+    
+    def _set_cached(self, cache_key, text):
+        """Cache a successful response, empty responses aren't cached"""
+        if cache_key is None or not text:
+            return
+        with self._response_cache_lock:
+            self._response_cache[cache_key] = text
+    
+    def _parse_response(self, status_code, content):
+        """Extract the generated text from an API response
+        
+        Args:
+            status_code: HTTP status code of the response
+            content: Raw response body
+            
+        Returns:
+            (text, success), text is the generated response or an error message
+        """
+        # Generation responses double as availability probes
+        if status_code in (200, 401, 404):
+            self._set_cached_availability(self._availability_from_status(status_code))
+        
+        if status_code != 200:
+            error_msg = f"HuggingFace API returned an error: {status_code}, {content.decode('utf-8', 'replace')}"
+            logger.error(error_msg)
+            return f"Error generating response: {error_msg}", False
+        
+        return self._parse_result(json_utils.loads(content))
+    
+    def _parse_result(self, result):
+        """Extract the generated text from a decoded API result
+        
+        Args:
+            result: Decoded JSON result for one input
+            
+        Returns:
+            (text, success), text is the generated response or an error message
+        """
+        # Text-generation models return [{"generated_text": ...}], try that shape first
+        try:
+            generated_text = result[0]["generated_text"]
+        except (KeyError, IndexError, TypeError):
+            generated_text = self._extract_other_shapes(result)
+        
+        if isinstance(generated_text, str):
+            # Remove any prompt artifacts that might be included
+            return _PROMPT_ARTIFACT.sub("", generated_text, count=1), True
+        
+        # If we can't parse the result in any of the expected formats,
+        # return a generic message and log the full response
+        logger.warning("Unable to parse API response format: %s", result)
+        return "I'm having trouble generating a response right now. Please try again later.", False
+    
+    def _extract_other_shapes(self, result):
+        """Extract the generated text from the less common response shapes, or None"""
+        if isinstance(result, str):
+            # Some models return just the string
+            return result
+        elif isinstance(result, dict):
+            return result.get("generated_text")
+        elif isinstance(result, list) and result and isinstance(result[0], str):
+            # Some models return a list of strings
+            return result[0]
+        return None
+    
+    def _parse_stream_line(self, line):
+        """Extract the token text from one line of a streamed response
+        
+        The API sends server-sent events, one "data:{...}" line per token, or a
+        "data:{"error": ...}" line if generation fails.
+        
+        Returns:
+            (text, error), text is the token text or None for other lines and special
+            tokens, error is the error message to show if the API reported an error
+        """
+        if not line.startswith("data:"):
+            return None, None
+        try:
+            event = json_utils.loads(line[5:])
+        except json_utils.JSONDecodeError:
+            logger.debug("Skipping malformed stream line: %s", line)
+            return None, None
+        if not isinstance(event, dict):
+            return None, None
+        
+        if event.get("error"):
+            error_msg = f"HuggingFace API returned an error: {event['error']}"
+            logger.error(error_msg)
+            return None, f"Error generating response: {error_msg}"
+        
+        token = event.get("token") or {}
+        if token.get("special"):
+            return None, None
+        return token.get("text"), None
+    
+    def _finish_stream(self, cache_key, chunks):
+        """Record a stream that completed without an error: the API is available and the response is cached"""
+        self._set_cached_availability(self._availability_from_status(200))
+        self._set_cached(cache_key, "".join(chunks))
+    
+    def generate_response(self, messages):
+        """Generate a response
+        
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            
+        Returns:
+            Generated response text
+        """
+        payload = self._build_request(messages)
+        if payload is None:
+            return "No user message found to respond to."
+        
+        body = json_utils.dumps_bytes(payload)
+        cache_key = self._cache_key(body)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             # Send request
-            response = requests.post(self.api_url, headers=headers, json=payload)
+            response = self._session.post(self.api_url, data=body, timeout=(3.05, 60))
+            text, success = self._parse_response(response.status_code, response.content)
+            if success:
+                self._set_cached(cache_key, text)
+            return text
+        
+        except Exception as e:
+            error_msg = f"Error generating response using HuggingFace API: {str(e)}"
+            logger.exception(error_msg)
+            return f"Sorry, an error occurred while generating a response: {str(e)}"
+    
+    def generate_response_stream(self, messages):
+        """Generate a response, yielding text chunks as the API streams tokens
+        
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
             
-            # Check response
-            if response.status_code == 200:
-                result = response.json()
-                
-                # Extract the generated text from the response
-                if isinstance(result, str):
-                    # Some models return just the string
-                    return result
-                elif isinstance(result, list) and len(result) > 0:
-                    # Some models return a list with the first item containing the generated text
-                    if isinstance(result[0], str):
-                        return result[0]
-                    elif isinstance(result[0], dict):
-                        if "generated_text" in result[0]:
-                            # Extract just the generated text, not the prompt
-                            generated_text = result[0]["generated_text"]
-                            # Remove any prompt artifacts that might be included
-                            if "[/INST]" in generated_text:
-                                generated_text = generated_text.split("[/INST]", 1)[1].strip()
-                            return generated_text
-                elif isinstance(result, dict):
-                    if "generated_text" in result:
-                        generated_text = result["generated_text"]
-                        # Remove any prompt artifacts that might be included
-                        if "[/INST]" in generated_text:
-                            generated_text = generated_text.split("[/INST]", 1)[1].strip()
-                        return generated_text
+        Yields:
+            Pieces of the generated response text
+        """
+        payload = self._build_request(messages)
+        if payload is None:
+            yield "No user message found to respond to."
+            return
+        
+        # Streamed and non-streamed requests share cache entries
+        cache_key = self._cache_key(json_utils.dumps_bytes(payload))
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        body = json_utils.dumps_bytes({**payload, "stream": True})
+        chunks = []
+        try:
+            with self._session.post(self.api_url, data=body, timeout=(3.05, 60), stream=True) as response:
+                if response.status_code != 200:
+                    text, _ = self._parse_response(response.status_code, response.content)
+                    yield text
+                    return
                 
-                # If we can't parse the result in any of the expected formats,
-                # return a generic message and log the full response
-                print(f"Unable to parse API response format: {str(result)}")
-                return "I'm having trouble generating a response right now. Please try again later."
+                for line in response.iter_lines(decode_unicode=True):
+                    text, error = self._parse_stream_line(line)
+                    if error:
+                        yield error
+                        return
+                    if text:
+                        chunks.append(text)
+                        yield text
+            
+            self._finish_stream(cache_key, chunks)
+        
+        except Exception as e:
+            error_msg = f"Error generating response using HuggingFace API: {str(e)}"
+            logger.exception(error_msg)
+            yield f"Sorry, an error occurred while generating a response: {str(e)}"
+    
+    async def agenerate_response(self, messages):
+        """Generate a response without blocking the event loop
+        
+        Uses the shared connection pool, so concurrent chats don't wait on each other.
+        
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            
+        Returns:
+            Generated response text
+        """
+        payload = self._build_request(messages)
+        if payload is None:
+            return "No user message found to respond to."
+        
+        body = json_utils.dumps_bytes(payload)
+        cache_key = self._cache_key(body)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            if self.batch_max_size > 1:
+                # Share the request with other chats waiting at the same time
+                text, success = await self._get_batcher(payload["parameters"]).submit(payload["inputs"])
             else:
-                error_msg = f"HuggingFace API returned an error: {response.status_code}, {response.text}"
-                print(error_msg)
-                return f"Error generating response: {error_msg}"
+                # Send request
+                response = await _client.post(self.api_url, headers=self._headers, content=body)
+                text, success = self._parse_response(response.status_code, response.content)
+            if success:
+                self._set_cached(cache_key, text)
+            return text
         
         except Exception as e:
             error_msg = f"Error generating response using HuggingFace API: {str(e)}"
-            print(error_msg)
-            traceback.print_exc()
+            logger.exception(error_msg)
             return f"Sorry, an error occurred while generating a response: {str(e)}"
+    
+    async def astream_response(self, messages):
+        """Generate a response, yielding text chunks as the API streams tokens
+        
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            
+        Yields:
+            Pieces of the generated response text
+        """
+        payload = self._build_request(messages)
+        if payload is None:
+            yield "No user message found to respond to."
+            return
+        
+        # Streamed and non-streamed requests share cache entries
+        cache_key = self._cache_key(json_utils.dumps_bytes(payload))
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        # Batched requests can't be streamed, the whole response is sent at once
+        if self.batch_max_size > 1:
+            yield await self.agenerate_response(messages)
+            return
+        
+        body = json_utils.dumps_bytes({**payload, "stream": True})
+        chunks = []
+        try:
+            async with _client.stream("POST", self.api_url, headers=self._headers, content=body) as response:
+                if response.status_code != 200:
+                    text, _ = self._parse_response(response.status_code, await response.aread())
+                    yield text
+                    return
+                
+                async for line in response.aiter_lines():
+                    text, error = self._parse_stream_line(line)
+                    if error:
+                        yield error
+                        return
+                    if text:
+                        chunks.append(text)
+                        yield text
+            
+            self._finish_stream(cache_key, chunks)
+        
+        except Exception as e:
+            error_msg = f"Error generating response using HuggingFace API: {str(e)}"
+            logger.exception(error_msg)
+            yield f"Sorry, an error occurred while generating a response: {str(e)}"
@@ -0,0 +1,54 @@
+import json
+
+# orjson is much faster than the standard library, use it when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+JSONDecodeError = json.JSONDecodeError
+
+def loads(data):
+    """
+    Parse a JSON document.
+
+    Args:
+        data: JSON text as str or bytes
+
+    Returns:
+        Parsed Python object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_bytes(obj, indent=False):
+    """
+    Serialize an object to UTF-8 encoded JSON.
+
+    Args:
+        obj: Object to serialize
+        indent: Whether to pretty-print with two-space indentation
+
+    Returns:
+        bytes: Encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def dumps(obj, indent=False):
+    """
+    Serialize an object to a JSON string.
+
+    Args:
+        obj: Object to serialize
+        indent: Whether to pretty-print with two-space indentation
+
+    Returns:
+        str: JSON text
+    """
+    return dumps_bytes(obj, indent).decode('utf-8')
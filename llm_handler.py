@@ -1,27 +1,110 @@
-import json
+import json_utils
 import os
-import torch
-import traceback
+import copy
+import importlib.util
+import time
+import hashlib
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import logging
 import requests
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
-from dotenv import load_dotenv
-from env_utils import is_production
+from env_utils import is_production, load_config
+from huggingface_handler import HuggingFaceHandler
+from http_utils import create_session
+
+logger = logging.getLogger(__name__)
+
+# diskcache is optional, responses are only cached on disk when it is installed
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+# Text that ends a reply: Llama 3's end of turn and end of text tokens, and the
+# end of sequence token of older Llama and Mistral models
+_STOP_SEQUENCES = ["<|eot_id|>", "<|end_of_text|>", "</s>"]
+
+# Start of the texts returned instead of a response when generation fails, these aren't cached
+_ERROR_PREFIXES = (
+    "Sorry, an error occurred",
+    "Error generating response",
+    "API response parsing error",
+    "Unable to generate response",
+    "No user message found",
+)
+
+# Shared async HTTP client for Ollama, used by the web server so concurrent chats
+# don't each hold a worker thread. Ollama is served over plain HTTP/1.1.
+_ollama_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(120.0, connect=3.05),
+    limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+    headers={"Content-Type": "application/json"}
+)
+
+async def close_ollama_client():
+    """Close the shared async Ollama client"""
+    await _ollama_client.aclose()
+
+# Open response caches per directory, shared by all handlers
+_disk_caches = {}
+
+def _open_disk_cache(directory, size_limit):
+    """Open a response cache directory, or return the one already open"""
+    cache = _disk_caches.get(directory)
+    if cache is None:
+        cache = _disk_caches[directory] = diskcache.Cache(directory, size_limit=size_limit)
+    return cache
+
+# Handlers shared by all chat sessions, keyed by configuration file path
+_SHARED_HANDLERS = {}
+_shared_handlers_lock = threading.Lock()
+
+def get_llm_handler(config_path="config.json"):
+    """Get the shared LLM handler for a configuration file
+    
+    Local models are loaded once and used by every session instead of once per session.
+    
+    Args:
+        config_path: Path to the configuration file
+    
+    Returns:
+        LLMHandler instance shared across sessions
+    """
+    with _shared_handlers_lock:
+        handler = _SHARED_HANDLERS.get(config_path)
+        if handler is None:
+            handler = _SHARED_HANDLERS[config_path] = LLMHandler(config_path)
+        return handler
 
 class LLMHandler:
     """Class for handling LLM model loading and inference"""
     
+    # Ollama request timeouts in seconds, as (connect, read). The read timeout also
+    # covers Ollama loading the model into memory before the first token.
+    OLLAMA_TIMEOUT = (3.05, 120)
+    
+    # Seconds a fetched Ollama model list is reused
+    OLLAMA_MODELS_TTL = 30
+    # Last fetched Ollama model list per base URL, as (timestamp, model names)
+    _ollama_models_cache = {}
+    
+    # Share of free GPU memory the offloaded llama.cpp layers may use, the rest is
+    # left for the KV cache and scratch buffers
+    GPU_MEMORY_FRACTION = 0.85
+    
+    # Short dtype names accepted in the configuration
+    DTYPE_ALIASES = {"bf16": "bfloat16", "fp16": "float16", "fp32": "float32"}
+    
     def __init__(self, config_path="config.json"):
         """Initialize LLM handler
         
         Args:
             config_path: Path to configuration file
         """
-        # Load environment variables
-        load_dotenv()
-        
-        # Load configuration
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
+        # Load configuration (environment variables are loaded by env_utils)
+        self.config = load_config(config_path)
         
         # Check if running in production
         self.is_production = is_production()
@@ -31,71 +114,237 @@ class LLMHandler:
             self.use_ollama = False
             self.use_llama_cpp = False
             self.use_huggingface_api = True
-            print("Running in production mode, using HuggingFace API")
+            logger.info("Running in production mode, using HuggingFace API")
         else:
             self.use_ollama = self.config['model'].get('use_ollama', False)
             self.use_llama_cpp = self.config['model'].get('use_llama_cpp', False)
             self.use_huggingface_api = self.config['model'].get('use_huggingface_api', False)
-            print(f"Running in local mode, using {'Ollama' if self.use_ollama else 'local model'}")
+            logger.info("Running in local mode, using %s", 'Ollama' if self.use_ollama else 'local model')
         
         self.model_name = self.config['model']['name']
         self.ollama_base_url = self.config['model'].get('ollama_base_url', 'http://localhost:11434')
+        # Pooled session so Ollama requests reuse connections, all request bodies are JSON
+        self._ollama_session = create_session({"Content-Type": "application/json"}) if self.use_ollama else None
         self.local_model_path = self.config['model'].get('local_model_path', '')
         self.device = self.config['model']['device']
-        self.dtype = self.config['model']['dtype']
+        self.dtype = self.DTYPE_ALIASES.get(self.config['model']['dtype'], self.config['model']['dtype'])
         
         # HuggingFace API configuration
         self.huggingface_api_key = os.getenv("HUGGINGFACE_API_KEY")
         self.huggingface_model_name = self.config.get('huggingface', {}).get('model_name', 
                                      self.config['model'].get('huggingface_model_name', 
                                      'meta-llama/Meta-Llama-3.1-8B-Instruct'))
-        self.huggingface_api_url = f"https://api-inference.huggingface.co/models/{self.huggingface_model_name}"
+        self.hf_handler = HuggingFaceHandler(config_path) if self.use_huggingface_api else None
         
         # llama-cpp-python specific configuration
         self.context_size = self.config['model'].get('context_size', 4096)
         self.n_gpu_layers = self.config['model'].get('n_gpu_layers', -1)
-        self.n_threads = self.config['model'].get('n_threads', 4)
+        # Leave one core for the UI or server when the thread count isn't configured
+        self.n_threads = self.config['model'].get('n_threads', max(1, (os.cpu_count() or 2) - 1))
+        self.prompt_cache_bytes = self.config['model'].get('prompt_cache_bytes', 2 << 30)
+        self.n_batch = self.config['model'].get('n_batch', 512)
+        self.use_mlock = self.config['model'].get('use_mlock', False)
+        self.flash_attn = self.config['model'].get('flash_attn', False)
         
-        # Set torch data type
-        if self.dtype == "bfloat16":
-            self.torch_dtype = torch.bfloat16
-        elif self.dtype == "float16":
-            self.torch_dtype = torch.float16
-        else:
-            self.torch_dtype = torch.float32
+        # Transformers specific configuration
+        self.compile_model = self.config['model'].get('compile', False)
+        self.quantization = self.config['model'].get('quantization')
+        # A quantized dtype ("int8", "int4", "nf4") loads the model quantized, computing in bfloat16
+        if self.dtype in ("int8", "int4", "nf4"):
+            self.quantization = self.quantization or self.dtype
+            self.dtype = "bfloat16"
         
         # Model and tokenizer
         self.model = None
         self.tokenizer = None
-        self.pipe = None
         self.llama_cpp_model = None
+        self._load_lock = threading.Lock()
+        # Set once the backend is prepared, later sessions skip the checks and warm-up
+        self._ready = False
+        self._generate_lock = threading.Lock()
         
         # System prompt
         self.system_prompt = self.config['chat']['system_prompt']
         self.max_new_tokens = self.config['chat']['max_new_tokens']
+        
+        # On-disk cache of responses, keyed by backend, model, settings and conversation
+        self._response_cache = None
+        if self.config['chat'].get('cache_enabled', False):
+            if diskcache is None:
+                logger.warning("Response cache is enabled, but diskcache is not installed (pip install diskcache)")
+            else:
+                self._response_cache = _open_disk_cache(
+                    self.config['chat'].get('cache_dir', '.llm_cache'),
+                    self.config['chat'].get('cache_size_limit', 2 << 30)
+                )
+        
+        # llama-cpp generation settings, the same for every message
+        self._llama_cpp_generation_kwargs = {
+            "max_tokens": self.max_new_tokens,
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "repeat_penalty": 1.1,
+            "stop": _STOP_SEQUENCES,
+            "stream": False
+        }
+        
+        # Parts of the Ollama chat request that are the same for every message
+        self._ollama_base_payload = {
+            "model": self.model_name,
+            "options": {
+                "num_predict": self.max_new_tokens,
+                "temperature": 0.5,  # Lower temperature for more deterministic responses
+                "top_p": 0.9,        # Add top_p parameter to control diversity
+                "stop": _STOP_SEQUENCES  # Replaces the model's own stop list
+            }
+        }
+    
+    def _get_ollama_models(self):
+        """Get the names of the models downloaded in Ollama, reusing a recent result
+        
+        Returns:
+            (status_code, model names), model names is None if the request failed
+        """
+        cached = self._ollama_models_cache.get(self.ollama_base_url)
+        if cached and time.monotonic() - cached[0] < self.OLLAMA_MODELS_TTL:
+            return 200, cached[1]
+        
+        response = self._ollama_session.get(f"{self.ollama_base_url}/api/tags", timeout=self.OLLAMA_TIMEOUT)
+        if response.status_code != 200:
+            return response.status_code, None
+        
+        models = json_utils.loads(response.content).get('models', [])
+        available_models = [model['name'] for model in models]
+        self._ollama_models_cache[self.ollama_base_url] = (time.monotonic(), available_models)
+        return 200, available_models
+    
+    def _resolve_dtype(self):
+        """Get the torch data type configured for Transformers models
+        
+        torch is imported here so the other backends don't pay for loading it.
+        """
+        import torch
+        
+        # Unknown names fall back to float32
+        return {"bfloat16": torch.bfloat16, "float16": torch.float16}.get(self.dtype, torch.float32)
+    
+    @property
+    def precision(self):
+        """Precision of the loaded Transformers model, e.g. "bfloat16" or "int8"
+        
+        None for the other backends, whose precision is set by the model file or service.
+        """
+        if self.model is None:
+            return None
+        if self.quantization:
+            return self.quantization
+        return self.dtype if self.dtype in ("bfloat16", "float16") else "float32"
+    
+    def _select_attn_implementation(self):
+        """Choose the fused attention kernels for the Transformers model
+        
+        FlashAttention 2 is used on CUDA GPUs when flash-attn is installed and the model
+        runs in half precision, otherwise PyTorch's scaled dot-product attention.
+        """
+        import torch
+        
+        if (torch.cuda.is_available()
+                and importlib.util.find_spec("flash_attn") is not None
+                and self.dtype in ("bfloat16", "float16")):
+            return "flash_attention_2"
+        return "sdpa"
+    
+    def _build_quantization_config(self):
+        """Get the bitsandbytes quantization settings for the Transformers model
+        
+        Returns:
+            BitsAndBytesConfig, or None if the model isn't quantized
+        """
+        if not self.quantization:
+            return None
+        
+        # bitsandbytes is only needed when quantization is configured
+        from transformers import BitsAndBytesConfig
+        
+        if self.quantization == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True)
+        elif self.quantization in ("nf4", "int4"):
+            # NF4 keeps more accuracy than plain 4-bit, double quantization also
+            # compresses the quantization constants
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=self._resolve_dtype(),
+                bnb_4bit_use_double_quant=True,
+            )
+        else:
+            raise ValueError(f"Unsupported quantization: {self.quantization}, use int8, int4 or nf4")
     
     def _check_ollama_availability(self):
         """Check if Ollama service is available"""
         try:
-            response = requests.get(f"{self.ollama_base_url}/api/tags")
-            if response.status_code == 200:
-                models = response.json().get('models', [])
-                available_models = [model['name'] for model in models]
-                
+            status_code, available_models = self._get_ollama_models()
+            if available_models is not None:
                 if self.model_name in available_models:
-                    print(f"Ollama model {self.model_name} is available")
+                    logger.info("Ollama model %s is available", self.model_name)
                     return True, "Ollama service is available, model has been downloaded"
                 else:
-                    print(f"Ollama service is available, but model {self.model_name} was not found")
-                    print(f"Available models: {available_models}")
+                    logger.warning("Ollama service is available, but model %s was not found", self.model_name)
+                    logger.warning("Available models: %s", available_models)
                     return False, f"Model {self.model_name} not found in Ollama. Please use 'ollama pull {self.model_name}' to download the model."
             else:
-                return False, f"Ollama service response abnormal: {response.status_code}"
+                return False, f"Ollama service response abnormal: {status_code}"
         except requests.exceptions.ConnectionError:
             return False, f"Cannot connect to Ollama service, please make sure Ollama is running (URL: {self.ollama_base_url})"
         except Exception as e:
             return False, f"Error checking Ollama service: {str(e)}"
     
+    def _fit_gpu_layers(self, llama_class):
+        """Get the number of llama.cpp layers to offload to the GPU
+        
+        A configured layer count is used as is. With -1 or "auto", the layers are
+        offloaded as far as free CUDA memory allows, estimating the size of a layer
+        from the model file. Offloading more than fits makes loading fail or fall
+        back to the CPU, which is many times slower.
+        
+        Args:
+            llama_class: llama_cpp.Llama, used to read the model's layer count
+            
+        Returns:
+            Number of layers to offload, -1 for all
+        """
+        if self.n_gpu_layers not in (-1, "auto"):
+            return self.n_gpu_layers
+        
+        try:
+            import torch
+            if not torch.cuda.is_available():
+                # Apple Silicon shares memory with the GPU, offload everything
+                return -1
+            free_bytes, _ = torch.cuda.mem_get_info(0)
+        except (ImportError, RuntimeError):
+            # No torch, or a CUDA build without a usable device or driver
+            logger.debug("Unable to read free GPU memory, offloading all layers", exc_info=True)
+            return -1
+        
+        try:
+            # Loading only the vocabulary reads the metadata without the weights
+            probe = llama_class(model_path=self.local_model_path, vocab_only=True, verbose=False)
+            metadata = probe.metadata
+            architecture = metadata.get("general.architecture", "llama")
+            n_layers = int(metadata[f"{architecture}.block_count"])
+        except Exception:
+            logger.debug("Unable to read the layer count, offloading all layers", exc_info=True)
+            return -1
+        
+        # Embedding and output weights take about as much as one more layer
+        layer_bytes = os.path.getsize(self.local_model_path) / (n_layers + 1)
+        n_fit = int(free_bytes * self.GPU_MEMORY_FRACTION / layer_bytes)
+        if n_fit >= n_layers:
+            return -1
+        logger.info("Offloading %s of %s layers to fit in free GPU memory", n_fit, n_layers)
+        return max(0, n_fit)
+    
     def _check_llama_cpp_model(self):
         """Check if llama-cpp-python model file exists"""
         if not os.path.exists(self.local_model_path):
@@ -104,81 +353,158 @@ class LLMHandler:
         return True, "Model file check passed"
     
     def load_model(self):
+        """Load model and tokenizer, a backend that is already prepared is reused
+        
+        Returns:
+            True if the model is ready to generate responses
+        """
+        # Sessions sharing the handler may initialize at the same time
+        with self._load_lock:
+            if not self._ready:
+                self._ready = self._load_model()
+            return self._ready
+    
+    def _load_model(self):
         """Load model and tokenizer"""
         try:
-            print(f"Preparing model: {self.model_name if not self.is_production else self.huggingface_model_name}")
+            logger.info("Preparing model: %s", self.model_name if not self.is_production else self.huggingface_model_name)
             
             if self.is_production or self.use_huggingface_api:
                 # Check HuggingFace API key
                 if not self.huggingface_api_key:
-                    print("HuggingFace API key not set, please set HUGGINGFACE_API_KEY in the .env file")
+                    logger.error("HuggingFace API key not set, please set HUGGINGFACE_API_KEY in the .env file")
                     return False
                 
-                print(f"Using HuggingFace Inference API: {self.huggingface_model_name}")
+                logger.info("Using HuggingFace Inference API: %s", self.huggingface_model_name)
                 return True
                 
             elif self.use_llama_cpp:
                 # Check model file
                 is_valid, message = self._check_llama_cpp_model()
                 if not is_valid:
-                    print(f"Model file check failed: {message}")
+                    logger.error("Model file check failed: %s", message)
                     return False
                 
                 # Import llama_cpp
                 try:
-                    from llama_cpp import Llama
+                    from llama_cpp import Llama, LlamaRAMCache
                 except ImportError:
-                    print("Cannot import llama_cpp module, please make sure llama-cpp-python is installed")
+                    logger.error("Cannot import llama_cpp module, please make sure llama-cpp-python is installed")
                     return False
                 
-                print(f"Loading model: {self.local_model_path}")
-                print(f"Using configuration: n_gpu_layers={self.n_gpu_layers}, n_threads={self.n_threads}, n_ctx={self.context_size}")
+                logger.info("Loading model: %s", self.local_model_path)
+                n_gpu_layers = self._fit_gpu_layers(Llama)
+                logger.info("Using configuration: n_gpu_layers=%s, n_threads=%s, n_ctx=%s", n_gpu_layers, self.n_threads, self.context_size)
                 
                 # Load model
                 try:
                     self.llama_cpp_model = Llama(
                         model_path=self.local_model_path,
-                        n_gpu_layers=self.n_gpu_layers,
+                        n_gpu_layers=n_gpu_layers,
                         n_ctx=self.context_size,
                         n_threads=self.n_threads,
+                        n_batch=self.n_batch,  # Prompt tokens evaluated per step
+                        use_mmap=True,  # Map the weights instead of copying them into memory
+                        use_mlock=self.use_mlock,  # Keep the weights from being swapped out
+                        offload_kqv=True,
+                        flash_attn=self.flash_attn,
                         verbose=False
                     )
-                    print("Model loading complete!")
+                    # Keep evaluated prompt states so sessions sharing a prefix skip re-evaluating it
+                    if self.prompt_cache_bytes > 0:
+                        self.llama_cpp_model.set_cache(LlamaRAMCache(capacity_bytes=self.prompt_cache_bytes))
+                    self._warm_up_llama_cpp()
+                    logger.info("Model loading complete!")
                     return True
                 except Exception as e:
-                    print(f"Error loading model: {str(e)}")
-                    traceback.print_exc()
+                    logger.exception("Error loading model: %s", e)
                     return False
                 
             elif self.use_ollama:
                 # Check Ollama service
                 is_available, message = self._check_ollama_availability()
                 if not is_available:
-                    print(f"Ollama check failed: {message}")
+                    logger.error("Ollama check failed: %s", message)
                     return False
                 
-                print("Ollama service check passed, model is available")
+                logger.info("Ollama service check passed, model is available")
+                self._warm_up_ollama()
                 return True
             else:
                 # Original code for loading models using Transformers
-                print("Loading model using Transformers")
+                logger.info("Loading model using Transformers")
+                # Imported here since loading transformers is slow and only this backend needs it
+                from transformers import AutoModelForCausalLM, AutoTokenizer
+                
+                model_kwargs = {
+                    "device_map": self.device,
+                    "attn_implementation": self._select_attn_implementation(),
+                }
+                quantization_config = self._build_quantization_config()
+                if quantization_config is not None:
+                    logger.info("Loading model with %s quantization", self.quantization)
+                    model_kwargs["quantization_config"] = quantization_config
+                else:
+                    model_kwargs["torch_dtype"] = self._resolve_dtype()
+                
                 self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-                self.pipe = pipeline(
-                    "text-generation",
-                    model=self.model_name,
-                    tokenizer=self.tokenizer,
-                    model_kwargs={"torch_dtype": self.torch_dtype},
-                    device_map=self.device,
+                self.model = AutoModelForCausalLM.from_pretrained(self.model_name, **model_kwargs)
+                self.model.eval()
+                
+                if self.compile_model:
+                    if quantization_config is not None:
+                        # bitsandbytes kernels can't be compiled
+                        logger.warning("Skipping compile, it is not supported for quantized models")
+                    else:
+                        self._compile_transformers_model()
+                
+                # Generation settings, built once instead of on every call
+                self._generation_config = copy.deepcopy(self.model.generation_config)
+                self._generation_config.update(
+                    max_new_tokens=self.max_new_tokens,
+                    do_sample=True,
+                    temperature=0.7,
+                    top_p=0.9,
+                    use_cache=True,
+                    pad_token_id=self.tokenizer.eos_token_id,
                 )
+                self._warm_up_transformers()
             
-            print("Model preparation complete!")
+            logger.info("Model preparation complete!")
             return True
         except Exception as e:
-            print(f"Model preparation failed: {str(e)}")
-            print("Detailed error information:")
-            traceback.print_exc()
+            logger.exception("Model preparation failed: %s", e)
             return False
     
+    def _response_cache_key(self, messages):
+        """Get the response cache key for a conversation, or None if caching is disabled"""
+        if self._response_cache is None:
+            return None
+        
+        if self.is_production or self.use_huggingface_api:
+            backend = ("huggingface", self.hf_handler.model_name, self.hf_handler.temperature, self.hf_handler.top_p)
+        elif self.use_llama_cpp:
+            backend = ("llama_cpp", self.local_model_path)
+        elif self.use_ollama:
+            backend = ("ollama", self.model_name)
+        else:
+            backend = ("transformers", self.model_name, self.quantization)
+        
+        key_data = json_utils.dumps_bytes([backend, self.max_new_tokens, self.system_prompt, messages])
+        return hashlib.sha256(key_data).hexdigest()
+    
+    def _get_cached_response(self, cache_key):
+        """Get a cached response, or None"""
+        if cache_key is None:
+            return None
+        return self._response_cache.get(cache_key)
+    
+    def _cache_response(self, cache_key, response):
+        """Store a generated response, unless it is an error message"""
+        if cache_key is None or not response or response.startswith(_ERROR_PREFIXES):
+            return
+        self._response_cache.set(cache_key, response)
+    
     def generate_response(self, messages):
         """Generate response
         
@@ -188,6 +514,17 @@ class LLMHandler:
         Returns:
             Generated response text
         """
+        cache_key = self._response_cache_key(messages)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
+        response = self._generate(messages)
+        self._cache_response(cache_key, response)
+        return response
+    
+    def _generate(self, messages):
+        """Generate response with the configured backend"""
         if self.is_production or self.use_huggingface_api:
             return self._generate_with_huggingface_api(messages)
         elif self.use_llama_cpp:
@@ -197,6 +534,169 @@ class LLMHandler:
         else:
             return self._generate_with_transformers(messages)
     
+    def generate_response_stream(self, messages):
+        """Generate response, yielding text chunks as they are produced
+        
+        The HuggingFace API and Ollama stream tokens; other backends yield the whole response at once.
+        
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            
+        Yields:
+            Pieces of the generated response text
+        """
+        cache_key = self._response_cache_key(messages)
+        if cache_key is None:
+            yield from self._generate_stream(messages)
+            return
+        
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        # A stream that fails partway yields its text so far and then an error message,
+        # only responses that finished without one are cached
+        chunks = []
+        failed = False
+        for chunk in self._generate_stream(messages):
+            failed = failed or chunk.startswith(_ERROR_PREFIXES)
+            chunks.append(chunk)
+            yield chunk
+        if not failed:
+            self._cache_response(cache_key, "".join(chunks))
+    
+    def _generate_stream(self, messages):
+        """Generate response with the configured backend, yielding text chunks"""
+        if self.is_production or self.use_huggingface_api:
+            yield from self.hf_handler.generate_response_stream(messages)
+        elif self.use_llama_cpp:
+            yield self._generate_with_llama_cpp(messages)
+        elif self.use_ollama:
+            yield from self._stream_with_ollama(messages)
+        else:
+            yield self._generate_with_transformers(messages)
+    
+    async def agenerate_response(self, messages):
+        """Generate response without blocking the event loop
+        
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            
+        Returns:
+            Generated response text
+        """
+        if self.use_huggingface_api:
+            return await self.hf_handler.agenerate_response(messages)
+        
+        if self.use_ollama and not self.use_llama_cpp:
+            cache_key = self._response_cache_key(messages)
+            cached = self._get_cached_response(cache_key)
+            if cached is not None:
+                return cached
+            
+            response = await self._agenerate_with_ollama(messages)
+            self._cache_response(cache_key, response)
+            return response
+        
+        # Local models block, run them in a worker thread
+        return await asyncio.to_thread(self.generate_response, messages)
+    
+    async def astream_response(self, messages):
+        """Generate response, yielding text chunks as they are produced
+        
+        The HuggingFace API and Ollama stream tokens over the shared async clients; other
+        backends run in a worker thread and yield the whole response at once.
+        
+        Args:
+            messages: List of messages, format is [{"role": "user", "content": "hello"}, ...]
+            
+        Yields:
+            Pieces of the generated response text
+        """
+        if self.use_huggingface_api:
+            async for chunk in self.hf_handler.astream_response(messages):
+                yield chunk
+            return
+        
+        if self.use_ollama and not self.use_llama_cpp:
+            cache_key = self._response_cache_key(messages)
+            cached = self._get_cached_response(cache_key)
+            if cached is not None:
+                yield cached
+                return
+            
+            # Only cache responses that finished without an error message
+            chunks = []
+            failed = False
+            async for chunk in self._astream_with_ollama(messages):
+                failed = failed or chunk.startswith(_ERROR_PREFIXES)
+                chunks.append(chunk)
+                yield chunk
+            if not failed:
+                self._cache_response(cache_key, "".join(chunks))
+            return
+        
+        # Local models block, pull each chunk in a worker thread
+        chunks = self.generate_response_stream(messages)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    
+    def batch_generate(self, messages_list):
+        """Generate responses for several conversations at once
+        
+        Transformers models generate all responses in one padded batch, the HuggingFace API
+        and Ollama are sent the requests in parallel. llama-cpp generates one response at a
+        time since the model is shared.
+        
+        Args:
+            messages_list: List of message lists, one per conversation
+            
+        Returns:
+            List of generated response texts, in the same order
+        """
+        cache_keys = [self._response_cache_key(messages) for messages in messages_list]
+        responses = [self._get_cached_response(cache_key) for cache_key in cache_keys]
+        
+        pending = [i for i, response in enumerate(responses) if response is None]
+        if pending:
+            generated = self._batch_generate([messages_list[i] for i in pending])
+            for i, response in zip(pending, generated):
+                responses[i] = response
+                self._cache_response(cache_keys[i], response)
+        return responses
+    
+    def _batch_generate(self, messages_list):
+        """Generate responses for several conversations with the configured backend"""
+        if self.is_production or self.use_huggingface_api or (self.use_ollama and not self.use_llama_cpp):
+            # Remote backends batch concurrent requests themselves
+            with ThreadPoolExecutor(max_workers=min(len(messages_list), 16)) as executor:
+                return list(executor.map(self._generate, messages_list))
+        elif self.use_llama_cpp:
+            return [self._generate_with_llama_cpp(messages) for messages in messages_list]
+        else:
+            return self._batch_generate_with_transformers(messages_list)
+    
+    async def abatch_generate(self, messages_list):
+        """Generate responses for several conversations without blocking the event loop
+        
+        Args:
+            messages_list: List of message lists, one per conversation
+            
+        Returns:
+            List of generated response texts, in the same order
+        """
+        if self.use_huggingface_api or (self.use_ollama and not self.use_llama_cpp):
+            # Sent together over the shared async clients, HuggingFace requests
+            # also share a batch when batch_max_size is set
+            return list(await asyncio.gather(*(self.agenerate_response(messages) for messages in messages_list)))
+        
+        # Local models block, run them in a worker thread
+        return await asyncio.to_thread(self.batch_generate, messages_list)
+    
     def _generate_with_llama_cpp(self, messages):
         """Generate response using llama-cpp-python"""
         try:
@@ -207,19 +707,14 @@ class LLMHandler:
             if not messages or messages[0].get("role") != "system":
                 messages = [{"role": "system", "content": self.system_prompt}] + messages
             
-            # Construct prompt
-            chat_format = "llama-3"  # Chat format for Llama 3 models
-            
-            # Use the model's chat method
-            response = self.llama_cpp_model.create_chat_completion(
-                messages=[{"role": m["role"], "content": m["content"]} for m in messages],
-                max_tokens=self.max_new_tokens,
-                temperature=0.7,
-                top_p=0.9,
-                repeat_penalty=1.1,
-                stop=["</s>"],
-                stream=False
-            )
+            # Use the model's chat method. The messages are passed unchanged so the rendered
+            # prompt keeps the same prefix between turns and llama.cpp only evaluates new tokens.
+            # The model is shared between sessions and can only generate one response at a time
+            with self._generate_lock:
+                response = self.llama_cpp_model.create_chat_completion(
+                    messages=messages,
+                    **self._llama_cpp_generation_kwargs
+                )
             
             # Extract response
             if "choices" in response and len(response["choices"]) > 0:
@@ -229,170 +724,283 @@ class LLMHandler:
             
         except Exception as e:
             error_msg = f"Error generating response using llama-cpp: {str(e)}"
-            print(error_msg)
-            traceback.print_exc()
+            logger.exception(error_msg)
             return f"Sorry, an error occurred while generating a response: {str(e)}"
     
+    def _build_ollama_payload(self, messages, stream=False):
+        """Build the Ollama chat request for a list of messages"""
+        # Ensure system prompt is at the beginning of the message list
+        if not messages or messages[0].get("role") != "system":
+            messages = [{"role": "system", "content": self.system_prompt}] + messages
+        
+        return {**self._ollama_base_payload, "messages": messages, "stream": stream}
+    
+    def _parse_ollama_line(self, line):
+        """Extract the message text from one line of an Ollama chat response
+        
+        Returns:
+            Message text, or None for empty, invalid or content-less lines
+        """
+        if not line:
+            return None
+        try:
+            frame = json_utils.loads(line)
+        except json_utils.JSONDecodeError:
+            logger.debug("Skipping invalid line in Ollama response: %r", line[:200])
+            return None
+        if not isinstance(frame, dict):
+            return None
+        return frame.get("message", {}).get("content")
+    
+    def _parse_ollama_response(self, response):
+        """Get the response text from a complete Ollama chat response
+        
+        Args:
+            response: requests or httpx response, both read the same way
+            
+        Returns:
+            Generated response text or an error message
+        """
+        if response.status_code != 200:
+            error_msg = f"Ollama API returned an error: {response.status_code}, {response.text}"
+            logger.error(error_msg)
+            return f"Error generating response: {error_msg}"
+        
+        # A single JSON document, or one per line if the response was streamed anyway
+        parts = [content for content in map(self._parse_ollama_line, response.iter_lines()) if content]
+        if parts:
+            return "".join(parts)
+        
+        error_msg = "Ollama API response contained no message"
+        logger.error(error_msg)
+        return f"Error generating response: {error_msg}"
+    
     def _generate_with_ollama(self, messages):
         """Generate response using Ollama API"""
         try:
-            # Ensure system prompt is at the beginning of the message list
-            if not messages or messages[0].get("role") != "system":
-                messages = [{"role": "system", "content": self.system_prompt}] + messages
-            
             # Construct Ollama API request
             api_url = f"{self.ollama_base_url}/api/chat"
-            payload = {
-                "model": self.model_name,
-                "messages": messages,
-                "stream": False,  # Explicitly specify non-streaming response
-                "options": {
-                    "num_predict": self.max_new_tokens,
-                    "temperature": 0.5,  # Lower temperature for more deterministic responses
-                    "top_p": 0.9,        # Add top_p parameter to control diversity
-                    "stop": ["</s>"]     # Add stop token
-                }
-            }
+            payload = self._build_ollama_payload(messages)
             
             # Send request
-            response = requests.post(api_url, json=payload)
+            response = self._ollama_session.post(
+                api_url,
+                data=json_utils.dumps_bytes(payload),
+                timeout=self.OLLAMA_TIMEOUT
+            )
             
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                    return result['message']['content']
-                except requests.exceptions.JSONDecodeError:
-                    # Try parsing JSON response line by line
-                    print("Trying to parse response line by line...")
-                    lines = response.text.strip().split('\n')
-                    if lines and len(lines) > 0:
-                        try:
-                            # Try to parse the last line of JSON
-                            last_json = json.loads(lines[-1])
-                            if 'message' in last_json and 'content' in last_json['message']:
-                                return last_json['message']['content']
-                        except:
-                            pass
-                    
-                    # If unable to parse JSON, return the text response directly
-                    print("Unable to parse JSON, returning original response")
-                    return f"API response parsing error, original response: {response.text[:200]}..."
-            else:
-                error_msg = f"Ollama API returned an error: {response.status_code}, {response.text}"
-                print(error_msg)
-                return f"Error generating response: {error_msg}"
+            return self._parse_ollama_response(response)
         
         except Exception as e:
             error_msg = f"Error generating response using Ollama: {str(e)}"
-            print(error_msg)
-            traceback.print_exc()
+            logger.exception(error_msg)
             return f"Sorry, an error occurred while generating a response: {str(e)}"
     
+    def _stream_with_ollama(self, messages):
+        """Generate response using Ollama API, yielding text chunks as they are generated"""
+        try:
+            api_url = f"{self.ollama_base_url}/api/chat"
+            payload = self._build_ollama_payload(messages, stream=True)
+            
+            with self._ollama_session.post(
+                api_url,
+                data=json_utils.dumps_bytes(payload),
+                timeout=self.OLLAMA_TIMEOUT,
+                stream=True
+            ) as response:
+                if response.status_code != 200:
+                    error_msg = f"Ollama API returned an error: {response.status_code}, {response.text}"
+                    logger.error(error_msg)
+                    yield f"Error generating response: {error_msg}"
+                    return
+                
+                # Ollama sends one JSON object per line
+                for line in response.iter_lines():
+                    content = self._parse_ollama_line(line)
+                    if content:
+                        yield content
+        
+        except Exception as e:
+            error_msg = f"Error generating response using Ollama: {str(e)}"
+            logger.exception(error_msg)
+            yield f"Sorry, an error occurred while generating a response: {str(e)}"
+    
+    async def _agenerate_with_ollama(self, messages):
+        """Generate response using Ollama API without blocking the event loop"""
+        try:
+            api_url = f"{self.ollama_base_url}/api/chat"
+            payload = self._build_ollama_payload(messages)
+            
+            response = await _ollama_client.post(api_url, content=json_utils.dumps_bytes(payload))
+            
+            return self._parse_ollama_response(response)
+        
+        except Exception as e:
+            error_msg = f"Error generating response using Ollama: {str(e)}"
+            logger.exception(error_msg)
+            return f"Sorry, an error occurred while generating a response: {str(e)}"
+    
+    async def _astream_with_ollama(self, messages):
+        """Generate response using Ollama API without blocking the event loop, yielding text chunks"""
+        try:
+            api_url = f"{self.ollama_base_url}/api/chat"
+            payload = self._build_ollama_payload(messages, stream=True)
+            
+            async with _ollama_client.stream("POST", api_url, content=json_utils.dumps_bytes(payload)) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    error_msg = f"Ollama API returned an error: {response.status_code}, {body.decode('utf-8', 'replace')}"
+                    logger.error(error_msg)
+                    yield f"Error generating response: {error_msg}"
+                    return
+                
+                # Ollama sends one JSON object per line
+                async for line in response.aiter_lines():
+                    content = self._parse_ollama_line(line)
+                    if content:
+                        yield content
+        
+        except Exception as e:
+            error_msg = f"Error generating response using Ollama: {str(e)}"
+            logger.exception(error_msg)
+            yield f"Sorry, an error occurred while generating a response: {str(e)}"
+    
+    def _compile_transformers_model(self):
+        """Compile the Transformers model's forward pass with torch.compile
+        
+        A static KV cache keeps tensor shapes fixed so the compiled graph is reused
+        between decoding steps. The graph is compiled by the warm-up generation that
+        load_model runs afterwards.
+        """
+        import torch
+        
+        logger.info("Compiling model, this can take a few minutes...")
+        self.model.generation_config.cache_implementation = "static"
+        self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False)
+    
+    def _warm_up_transformers(self):
+        """Run a one-token generation with the Transformers model
+        
+        Lazy initialization (CUDA kernels, KV cache buffers, paging in weights) then
+        happens while loading instead of on the first user message.
+        """
+        import torch
+        
+        try:
+            input_ids = self.tokenizer.apply_chat_template(
+                [{"role": "system", "content": self.system_prompt}],
+                add_generation_prompt=True,
+                return_tensors="pt"
+            ).to(self.model.device)
+            with torch.inference_mode():
+                self.model.generate(input_ids=input_ids, generation_config=self._generation_config, max_new_tokens=1)
+        except Exception:
+            logger.debug("Transformers warm-up failed", exc_info=True)
+    
+    def _warm_up_llama_cpp(self):
+        """Run a one-token generation with the llama.cpp model
+        
+        This also leaves the system prompt evaluated for the first chat.
+        """
+        try:
+            self.llama_cpp_model.create_chat_completion(
+                messages=[{"role": "system", "content": self.system_prompt}],
+                max_tokens=1
+            )
+        except Exception:
+            logger.debug("llama-cpp warm-up failed", exc_info=True)
+    
+    def _warm_up_ollama(self):
+        """Ask Ollama to load the model into memory
+        
+        A chat request without messages loads the model without generating anything.
+        """
+        try:
+            self._ollama_session.post(
+                f"{self.ollama_base_url}/api/chat",
+                data=json_utils.dumps_bytes({"model": self.model_name, "messages": []}),
+                timeout=self.OLLAMA_TIMEOUT
+            )
+        except Exception:
+            logger.debug("Ollama warm-up failed", exc_info=True)
+    
     def _generate_with_transformers(self, messages):
         """Generate response using Transformers"""
-        if not self.pipe:
+        if not self.model:
             raise ValueError("Model not loaded, please call load_model() first")
         
+        import torch
+        
         # Ensure system prompt is at the beginning of the message list
         if not messages or messages[0].get("role") != "system":
             messages = [{"role": "system", "content": self.system_prompt}] + messages
         
         try:
-            outputs = self.pipe(
+            input_ids = self.tokenizer.apply_chat_template(
                 messages,
-                max_new_tokens=self.max_new_tokens,
-            )
+                add_generation_prompt=True,
+                return_tensors="pt"
+            ).to(self.model.device)
             
-            # Extract the generated response
-            response = outputs[0]["generated_text"][-1]["content"]
-            return response
+            # Generate without autograd bookkeeping
+            # The model is shared between sessions and can only generate one response at a time
+            with self._generate_lock, torch.inference_mode():
+                output = self.model.generate(input_ids=input_ids, generation_config=self._generation_config)
+            
+            # Decode only the generated tokens, not the prompt
+            response = self.tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+            return response.strip()
         except Exception as e:
-            print(f"Error generating response: {str(e)}")
-            traceback.print_exc()
+            logger.exception("Error generating response: %s", e)
             return "Sorry, an error occurred while generating a response."
-            
-    def _generate_with_huggingface_api(self, messages):
-        """Generate response using HuggingFace Inference API"""
-        try:
+    
+    def _batch_generate_with_transformers(self, messages_list):
+        """Generate responses for several conversations in one batch using Transformers"""
+        if not self.model:
+            raise ValueError("Model not loaded, please call load_model() first")
+        
+        import torch
+        
+        prompts = []
+        for messages in messages_list:
             # Ensure system prompt is at the beginning of the message list
             if not messages or messages[0].get("role") != "system":
                 messages = [{"role": "system", "content": self.system_prompt}] + messages
-            
-            # Construct request headers
-            headers = {
-                "Authorization": f"Bearer {self.huggingface_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            # Get only the last few messages to avoid context overflow
-            # For Llama models, we'll use just the system prompt and the last user message
-            last_user_msg = None
-            for msg in reversed(messages):
-                if msg["role"] == "user":
-                    last_user_msg = msg["content"]
-                    break
-            
-            if not last_user_msg:
-                return "No user message found to respond to."
-            
-            # Create a simple prompt with just the system message and last user query
-            system_msg = messages[0]["content"]
-            prompt = f"<s>[INST] {system_msg} [/INST]</s>\n<s>[INST] {last_user_msg} [/INST]"
-            
-            # Construct request body for text-generation API
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_new_tokens": self.max_new_tokens,
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "repetition_penalty": 1.1,
-                    "do_sample": True,
-                    "return_full_text": False
-                }
-            }
-            
-            # Send request
-            response = requests.post(self.huggingface_api_url, headers=headers, json=payload)
-            
-            # Check response
-            if response.status_code == 200:
-                result = response.json()
-                
-                # Extract the generated text from the response
-                if isinstance(result, str):
-                    # Some models return just the string
-                    return result
-                elif isinstance(result, list) and len(result) > 0:
-                    # Some models return a list with the first item containing the generated text
-                    if isinstance(result[0], str):
-                        return result[0]
-                    elif isinstance(result[0], dict):
-                        if "generated_text" in result[0]:
-                            # Extract just the generated text, not the prompt
-                            generated_text = result[0]["generated_text"]
-                            # Remove any prompt artifacts that might be included
-                            if "[/INST]" in generated_text:
-                                generated_text = generated_text.split("[/INST]", 1)[1].strip()
-                            return generated_text
-                elif isinstance(result, dict):
-                    if "generated_text" in result:
-                        generated_text = result["generated_text"]
-                        # Remove any prompt artifacts that might be included
-                        if "[/INST]" in generated_text:
-                            generated_text = generated_text.split("[/INST]", 1)[1].strip()
-                        return generated_text
-                
-                # If we can't parse the result in any of the expected formats,
-                # return a generic message and log the full response
-                print(f"Unable to parse API response format: {str(result)}")
-                return "I'm having trouble generating a response right now. Please try again later."
-            else:
-                error_msg = f"HuggingFace API returned an error: {response.status_code}, {response.text}"
-                print(error_msg)
-                return f"Error generating response: {error_msg}"
+            prompts.append(self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False))
         
+        try:
+            # The tokenizer and model are shared, other threads may generate at the same time
+            with self._generate_lock, torch.inference_mode():
+                # Pad on the left so every prompt ends right where generation starts. The shared
+                # tokenizer's padding settings are changed only for this call
+                padding_side, pad_token = self.tokenizer.padding_side, self.tokenizer.pad_token
+                try:
+                    self.tokenizer.padding_side = "left"
+                    if pad_token is None:
+                        self.tokenizer.pad_token = self.tokenizer.eos_token
+                    inputs = self.tokenizer(
+                        prompts,
+                        return_tensors="pt",
+                        padding=True,
+                        add_special_tokens=False
+                    ).to(self.model.device)
+                finally:
+                    self.tokenizer.padding_side = padding_side
+                    self.tokenizer.pad_token = pad_token
+                
+                output = self.model.generate(
+                    **inputs,
+                    generation_config=self._generation_config,
+                    pad_token_id=self.tokenizer.eos_token_id
+                )
+            
+            # Decode only the generated tokens, not the prompts
+            responses = self.tokenizer.batch_decode(output[:, inputs.input_ids.shape[1]:], skip_special_tokens=True)
+            return [response.strip() for response in responses]
         except Exception as e:
-            error_msg = f"Error generating response using HuggingFace API: {str(e)}"
-            print(error_msg)
-            return f"Sorry, an error occurred while generating a response: {str(e)}"
+            logger.exception("Error generating responses: %s", e)
+            return ["Sorry, an error occurred while generating a response."] * len(messages_list)
+    
+    def _generate_with_huggingface_api(self, messages):
+        """Generate response using HuggingFace Inference API"""
+        return self.hf_handler.generate_response(messages)
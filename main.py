@@ -9,40 +9,31 @@ Based on Meta Llama 3.1 8B Instruct model
 import os
 import sys
 import json
+import logging
 from ui import ChatbotUI
+from env_utils import DEFAULT_CONFIG
 
-def check_config():
-    """Check if the configuration file exists, if not, create a default configuration"""
-    if not os.path.exists("config.json"):
-        default_config = {
-            "model": {
-                "name": "meta-llama/Meta-Llama-3.1-8B-Instruct",
-                "local_path": "",
-                "device": "auto",
-                "dtype": "bfloat16"
-            },
-            "ui": {
-                "title": "Simple Local Chatbot",
-                "width": 800,
-                "height": 600,
-                "theme": "light"
-            },
-            "chat": {
-                "max_history": 10,
-                "system_prompt": "You are a helpful AI assistant.",
-                "max_new_tokens": 256
-            }
-        }
-        
-        with open("config.json", "w", encoding="utf-8") as f:
-            json.dump(default_config, f, ensure_ascii=False, indent=4)
-        
-        print("Default configuration file created: config.json")
+def init_config(path="config.json"):
+    """Write the default configuration to a file, unless it already exists"""
+    if os.path.exists(path):
+        print(f"Configuration file already exists: {path}")
+        return
+    
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(DEFAULT_CONFIG, f, ensure_ascii=False, indent=4)
+    
+    print(f"Default configuration file created: {path}")
 
 def main():
     """Main function"""
-    # Check configuration file
-    check_config()
+    # Show model loading and error messages in the terminal
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
+    # Write a configuration file to edit with --init, otherwise
+    # missing settings fall back to the defaults
+    if "--init" in sys.argv[1:]:
+        init_config()
+        return
     
     # Create and run UI
     app = ChatbotUI()
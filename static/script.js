@@ -19,6 +19,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // Connection status
     let isConnected = false;
     
+    // Bot message currently being streamed
+    let streamingMessage = null;
+    
     // Show/hide chat window
     chatIcon.addEventListener('click', function() {
         chatContainer.style.display = 'flex';
@@ -52,6 +55,10 @@ document.addEventListener('DOMContentLoaded', function() {
             
             if (data.type === 'chat') {
                 addBotMessage(data.content);
+            } else if (data.type === 'chat_delta') {
+                appendBotMessageChunk(data.content);
+            } else if (data.type === 'chat_end') {
+                streamingMessage = null;
             } else if (data.type === 'status') {
                 addSystemMessage(data.content);
             }
@@ -88,6 +95,17 @@ document.addEventListener('DOMContentLoaded', function() {
         chatBody.scrollTop = chatBody.scrollHeight;
     }
     
+    // Append a streamed chunk to the current bot message
+    function appendBotMessageChunk(chunk) {
+        if (!streamingMessage) {
+            streamingMessage = document.createElement('div');
+            streamingMessage.className = 'bot-message';
+            chatBody.appendChild(streamingMessage);
+        }
+        streamingMessage.textContent += chunk;
+        chatBody.scrollTop = chatBody.scrollHeight;
+    }
+    
     // Add system message to chat window
     function addSystemMessage(message) {
         const messageElement = document.createElement('div');
@@ -147,6 +165,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // Only keep system messages
             const systemMessages = chatBody.querySelectorAll('.system-message');
             chatBody.innerHTML = '';
+            streamingMessage = null;
             systemMessages.forEach(msg => chatBody.appendChild(msg));
         }
     });
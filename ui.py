@@ -1,30 +1,151 @@
-import json
 import tkinter as tk
 from tkinter import scrolledtext, ttk, messagebox
+import os
+import collections
+import contextlib
+import queue
 import threading
 from chat_logic import ChatSession
+from chat_process import ChatSessionProcess
+from env_utils import load_config
+
+# User-facing text, the language is selected with the "lang" setting in the ui section
+# of the configuration, or the LANG_UI environment variable
+UI_STRINGS = {
+    "en": {
+        "chat_history": "Chat History",
+        "enter_message": "Enter Message",
+        "send": "Send",
+        "stop": "Stop",
+        "clear_history": "Clear History",
+        "load_model": "Load Model",
+        "loaded": "Loaded",
+        "notice": "Notice",
+        "error": "Error",
+        "confirm": "Confirm",
+        "status_not_loaded": "Status: Model not loaded",
+        "status_loading": "Status: Loading model...",
+        "status_loaded": "Status: Model loaded",
+        "status_load_failed": "Status: Model loading failed",
+        "status_generating": "Status: Generating response...",
+        "status_ready": "Status: Ready",
+        "status_error": "Status: Error occurred",
+        "already_loaded": "Model already loaded",
+        "model_loaded": "Model loading complete, you can start chatting now!",
+        "model_load_failed": "Model loading failed, please check configuration and model path",
+        "load_first": "Please load the model first",
+        "please_wait": "Generating response, please wait",
+        "generate_error": "Error generating response: {error}",
+        "confirm_clear": "Are you sure you want to clear the chat history?",
+        "history_cleared": "Chat history cleared",
+        "roles": {"User": "User", "Assistant": "Assistant", "System": "System"},
+    },
+    "zh": {
+        "chat_history": "聊天历史",
+        "enter_message": "输入消息",
+        "send": "发送",
+        "stop": "停止",
+        "clear_history": "清除历史",
+        "load_model": "加载模型",
+        "loaded": "已加载",
+        "notice": "提示",
+        "error": "错误",
+        "confirm": "确认",
+        "status_not_loaded": "状态：模型未加载",
+        "status_loading": "状态：正在加载模型...",
+        "status_loaded": "状态：模型已加载",
+        "status_load_failed": "状态：模型加载失败",
+        "status_generating": "状态：正在生成回复...",
+        "status_ready": "状态：就绪",
+        "status_error": "状态：发生错误",
+        "already_loaded": "模型已经加载",
+        "model_loaded": "模型已加载完成，可以开始聊天了！",
+        "model_load_failed": "模型加载失败，请检查配置和模型路径",
+        "load_first": "请先加载模型",
+        "please_wait": "正在生成回复，请稍候",
+        "generate_error": "生成回复时出错：{error}",
+        "confirm_clear": "确定要清除聊天历史吗？",
+        "history_cleared": "聊天历史已清除",
+        "roles": {"User": "用户", "Assistant": "助手", "System": "系统"},
+    },
+}
+
+# Button style shared by all buttons, colors are added from the theme
+BUTTON_STYLE = {
+    'padx': 15,         # Increase horizontal padding
+    'pady': 5,          # Add vertical padding
+    'relief': tk.RAISED,  # Use RAISED style for a slight 3D effect
+    'borderwidth': 1,   # Keep minimal border
+    'highlightthickness': 0,  # Remove highlight border
+    'font': ('TkDefaultFont', 10),  # Ensure appropriate font size
+    'width': 8  # Fixed width to ensure button is fully displayed
+}
+
+# Keys that move around the read-only chat history
+HISTORY_NAVIGATION_KEYS = frozenset({"Left", "Right", "Up", "Down", "Home", "End", "Prior", "Next"})
+
+class ThrottledScrolledText(scrolledtext.ScrolledText):
+    """ScrolledText that moves its scrollbar at most once per idle cycle, however often the text changes"""
+    
+    def __init__(self, master=None, **kw):
+        super().__init__(master, **kw)
+        # Latest scroll position not yet shown by the scrollbar
+        self._scroll_position = None
+        self['yscrollcommand'] = self._schedule_scrollbar_update
+    
+    def _schedule_scrollbar_update(self, first, last):
+        """Remember the new scroll position and update the scrollbar when idle"""
+        pending = self._scroll_position is not None
+        self._scroll_position = (first, last)
+        if not pending:
+            self.after_idle(self._update_scrollbar)
+    
+    def _update_scrollbar(self):
+        """Show the latest scroll position in the scrollbar"""
+        first, last = self._scroll_position
+        self._scroll_position = None
+        self.vbar.set(first, last)
 
 class ChatbotUI:
     """User interface for the chatbot"""
     
+    # Chat history tag used for each role name, other roles use "system_tag"
+    ROLE_TAGS = {"User": "user_tag", "Assistant": "assistant_tag"}
+    
     def __init__(self, config_path="config.json"):
         """Initialize the user interface
         
         Args:
             config_path: Path to the configuration file
         """
-        # Load configuration
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
+        # Load configuration (shared with the chat session, parsed once)
+        self.config = load_config(config_path)
+        lang = self.config['ui'].get('lang', os.environ.get("LANG_UI", "en"))
+        self.strings = UI_STRINGS.get(lang, UI_STRINGS["en"])
+        # Text shown before each message, e.g. "User: "
+        self._role_prefixes = {role: f"{name}: " for role, name in self.strings["roles"].items()}
+        
+        # Create chat session, optionally in a child process so a local model
+        # doesn't compete with the UI for the GIL while it generates
+        if self.config['ui'].get('inference_process', False):
+            self.chat_session = ChatSessionProcess(config_path)
+        else:
+            self.chat_session = ChatSession(config_path)
         
-        # Create chat session
-        self.chat_session = ChatSession(config_path)
+        # Worker thread for model loading and generation, jobs run one at a time in order.
+        # It is a daemon so closing the window doesn't wait for a running job
+        self._jobs = queue.Queue()
+        self._closed = False
+        threading.Thread(target=self._run_jobs, daemon=True).start()
         
         # Create main window
         self.root = tk.Tk()
         self.root.title(self.config['ui']['title'])
         self.root.geometry(f"{self.config['ui']['width']}x{self.config['ui']['height']}")
         
+        # Lines kept in the chat history display, older lines are removed
+        self.max_history_lines = self.config['ui'].get('max_history_lines', 2000)
+        
         # Set theme
         self.theme = self.config['ui']['theme']
         self.setup_theme()
@@ -35,6 +156,20 @@ class ChatbotUI:
         # Loading status
         self.is_model_loaded = False
         self.is_generating = False
+        
+        # Whether the chat history shows any messages, so a new one is preceded by a separator
+        self._history_nonempty = False
+        
+        # Streamed response text waiting to be shown, added to the display in one insert
+        # when the UI is idle rather than once per token
+        self._pending_chunks = collections.deque()
+        self._pending_lock = threading.Lock()
+        self._flush_scheduled = False
+        # Whether scrolling the chat history to the bottom is already scheduled
+        self._see_pending = False
+        
+        # Set to stop the response being generated
+        self._stop_event = threading.Event()
     
     def setup_theme(self):
         """Set UI theme"""
@@ -66,26 +201,38 @@ class ChatbotUI:
         history_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
         
         # Chat history label
-        history_label = tk.Label(history_frame, text="Chat History", bg=self.bg_color, fg=self.fg_color)
+        history_label = tk.Label(history_frame, text=self.strings["chat_history"], bg=self.bg_color, fg=self.fg_color)
         history_label.pack(anchor=tk.W, pady=(0, 5))
         
-        # Chat history text area
-        self.chat_history_text = scrolledtext.ScrolledText(
+        # Chat history text area, streamed responses change it often so its scrollbar is throttled
+        self.chat_history_text = ThrottledScrolledText(
             history_frame, 
             wrap=tk.WORD, 
             bg=self.input_bg, 
             fg=self.input_fg,
-            font=("TkDefaultFont", 10)
+            font=("TkDefaultFont", 10),
+            insertwidth=0  # Hide the cursor, the text can't be edited
         )
         self.chat_history_text.pack(fill=tk.BOTH, expand=True)
-        self.chat_history_text.config(state=tk.DISABLED)  # Set to read-only
+        
+        # Read-only: the widget stays in the normal state so messages can be added without
+        # switching states, and editing keys and paste events are ignored instead
+        self.chat_history_text.bind("<Key>", self._block_history_edit_key)
+        for sequence in ("<<Paste>>", "<<PasteSelection>>", "<<Cut>>", "<<Clear>>", "<<Undo>>", "<<Redo>>"):
+            self.chat_history_text.bind(sequence, lambda event: "break")
+        
+        # Role name styles
+        role_font = ("TkDefaultFont", 10, "bold")
+        self.chat_history_text.tag_configure("user_tag", foreground="blue", font=role_font)
+        self.chat_history_text.tag_configure("assistant_tag", foreground="green", font=role_font)
+        self.chat_history_text.tag_configure("system_tag", foreground="gray", font=role_font)
         
         # Input area
         input_frame = tk.Frame(main_frame, bg=self.bg_color)
         input_frame.pack(fill=tk.X, pady=(0, 10))
         
         # Input label
-        input_label = tk.Label(input_frame, text="Enter Message", bg=self.bg_color, fg=self.fg_color)
+        input_label = tk.Label(input_frame, text=self.strings["enter_message"], bg=self.bg_color, fg=self.fg_color)
         input_label.pack(anchor=tk.W, pady=(0, 5))
         
         # Input text area
@@ -100,55 +247,55 @@ class ChatbotUI:
             insertwidth=2  # Increase cursor width
         )
         self.input_text.pack(fill=tk.X)
+        # Enter sends the message, Shift+Enter falls through to the default newline insertion
         self.input_text.bind("<Return>", self.on_enter_key)
+        self.input_text.bind("<Shift-Return>", lambda event: None)
         
-        # Ensure input box gets focus
-        self.root.after(100, lambda: self.input_text.focus_set())
+        # Ensure input box gets focus once it is shown
+        self.input_text.bind("<Map>", self._focus_input_on_map)
         
         # Button area
         button_frame = tk.Frame(main_frame, bg=self.bg_color, height=40)  # Increase height
         button_frame.pack(fill=tk.X, pady=5)  # Add vertical margin
         button_frame.pack_propagate(False)  # Prevent frame from being compressed by child components
         
-        # Create button style
-        button_style = {
-            'bg': self.button_bg, 
-            'fg': self.button_fg,
-            'padx': 15,         # Increase horizontal padding
-            'pady': 5,          # Add vertical padding
-            'relief': tk.RAISED,  # Use RAISED style for a slight 3D effect
-            'borderwidth': 1,   # Keep minimal border
-            'highlightthickness': 0,  # Remove highlight border
-            'font': ('TkDefaultFont', 10),  # Ensure appropriate font size
-            'width': 8  # Fixed width to ensure button is fully displayed
-        }
+        # Create button style (theme colors on top of the shared style)
+        button_style = {**BUTTON_STYLE, 'bg': self.button_bg, 'fg': self.button_fg}
         
         # Send button
         self.send_button = tk.Button(
             button_frame, 
-            text="Send", 
+            text=self.strings["send"], 
             command=self.send_message,
             **button_style
         )
         self.send_button.pack(side=tk.RIGHT, padx=(5, 0), pady=5)  # Add margin
         
+        # Stop button, enabled while a response is generated
+        self.stop_button = tk.Button(
+            button_frame, 
+            text=self.strings["stop"], 
+            command=self.stop_generation,
+            state=tk.DISABLED,
+            **button_style
+        )
+        self.stop_button.pack(side=tk.RIGHT, padx=(5, 0), pady=5)  # Add margin
+        
         # Clear button
-        clear_button_style = button_style.copy()
-        clear_button_style['width'] = 10  # Increase width to fit "Clear History" text
+        clear_button_style = {**button_style, 'width': 10}  # Increase width to fit "Clear History" text
         self.clear_button = tk.Button(
             button_frame, 
-            text="Clear History", 
+            text=self.strings["clear_history"], 
             command=self.clear_history,
             **clear_button_style
         )
         self.clear_button.pack(side=tk.RIGHT, padx=(5, 0), pady=5)  # Add margin
         
         # Load model button
-        load_button_style = button_style.copy()
-        load_button_style['width'] = 10  # Increase width to fit "Load Model" text
+        load_button_style = {**button_style, 'width': 10}  # Increase width to fit "Load Model" text
         self.load_button = tk.Button(
             button_frame, 
-            text="Load Model", 
+            text=self.strings["load_model"], 
             command=self.load_model,
             **load_button_style
         )
@@ -157,62 +304,99 @@ class ChatbotUI:
         # Status label
         self.status_label = tk.Label(
             main_frame, 
-            text="Status: Model not loaded", 
+            text=self.strings["status_not_loaded"], 
             bg=self.bg_color, 
             fg=self.fg_color,
             anchor=tk.W
         )
         self.status_label.pack(fill=tk.X, pady=(5, 0))
     
+    def _block_history_edit_key(self, event):
+        """Ignore keys that would edit the chat history, keeping navigation, copy and select all"""
+        if event.keysym in HISTORY_NAVIGATION_KEYS:
+            return None
+        # Control (or Command on macOS) shortcuts for copy and select all
+        if event.state & 0xC and event.keysym.lower() in ("c", "a", "slash"):
+            return None
+        return "break"
+    
+    def _focus_input_on_map(self, event):
+        """Give the input box focus the first time it is shown"""
+        self.input_text.focus_set()
+        self.input_text.unbind("<Map>")
+    
     def load_model(self):
         """Load model"""
         if self.is_model_loaded:
-            messagebox.showinfo("Notice", "Model already loaded")
+            messagebox.showinfo(self.strings["notice"], self.strings["already_loaded"])
             return
         
-        self.status_label.config(text="Status: Loading model...")
+        self.status_label.config(text=self.strings["status_loading"])
         self.load_button.config(state=tk.DISABLED)
         
-        # Load model in a new thread
-        threading.Thread(target=self._load_model_thread, daemon=True).start()
+        # Load model in the worker thread
+        self._jobs.put((self._load_model_job, ()))
+    
+    def _run_jobs(self):
+        """Run queued jobs until None is received (worker thread)"""
+        for job, args in iter(self._jobs.get, None):
+            job(*args)
     
-    def _load_model_thread(self):
-        """Load model in a new thread"""
-        success = self.chat_session.initialize()
+    def _call_in_ui(self, callback, *args, idle=False):
+        """Run a callback in the main thread (called from the worker thread), unless the window is closed
+        
+        Args:
+            callback: Function to call
+            *args: Arguments for the callback
+            idle: Wait until the UI is idle instead of running it as soon as possible
+        """
+        if self._closed:
+            return
+        try:
+            if idle:
+                self.root.after_idle(callback, *args)
+            else:
+                self.root.after(0, callback, *args)
+        except (RuntimeError, tk.TclError):
+            # The window was closed meanwhile
+            pass
+    
+    def _load_model_job(self):
+        """Load model in the worker thread"""
+        try:
+            success = self.chat_session.initialize()
+        except Exception:
+            success = False
         
         # Update UI (in the main thread)
-        self.root.after(0, self._update_ui_after_loading, success)
+        self._call_in_ui(self._update_ui_after_loading, success)
     
     def _update_ui_after_loading(self, success):
         """Update UI after model loading"""
         if success:
             self.is_model_loaded = True
-            self.status_label.config(text="Status: Model loaded")
-            self.load_button.config(text="Loaded", state=tk.DISABLED)
-            self.append_to_history("System", "Model loading complete, you can start chatting now!")
+            precision = self.chat_session.precision
+            self.status_label.config(text=f"{self.strings['status_loaded']} ({precision})" if precision else self.strings["status_loaded"])
+            self.load_button.config(text=self.strings["loaded"], state=tk.DISABLED)
+            self.append_to_history("System", self.strings["model_loaded"])
         else:
-            self.status_label.config(text="Status: Model loading failed")
+            self.status_label.config(text=self.strings["status_load_failed"])
             self.load_button.config(state=tk.NORMAL)
-            messagebox.showerror("Error", "Model loading failed, please check configuration and model path")
+            messagebox.showerror(self.strings["error"], self.strings["model_load_failed"])
     
     def on_enter_key(self, event):
         """Handle Enter key event"""
-        # If Shift+Enter is pressed, insert a newline
-        if event.state & 0x1:  # Shift key is pressed
-            return
-        
-        # Otherwise send the message
         self.send_message()
         return "break"  # Prevent default Enter key behavior
     
     def send_message(self):
         """Send message"""
         if not self.is_model_loaded:
-            messagebox.showinfo("Notice", "Please load the model first")
+            messagebox.showinfo(self.strings["notice"], self.strings["load_first"])
             return
         
         if self.is_generating:
-            messagebox.showinfo("Notice", "Generating response, please wait")
+            messagebox.showinfo(self.strings["notice"], self.strings["please_wait"])
             return
         
         # Get user input
@@ -228,87 +412,142 @@ class ChatbotUI:
         
         # Set generation status
         self.is_generating = True
-        self.status_label.config(text="Status: Generating response...")
+        self.status_label.config(text=self.strings["status_generating"])
         self.send_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
+        self._stop_event.clear()
         
-        # Generate response in a new thread
-        threading.Thread(target=self._generate_response_thread, args=(user_input,), daemon=True).start()
+        # Generate response in the worker thread, it is shown as it is generated
+        self.append_to_history("Assistant", "")
+        self._jobs.put((self._generate_response_thread, (user_input,)))
     
     def _generate_response_thread(self, user_input):
-        """Generate response in a new thread"""
+        """Generate response in the worker thread"""
         try:
-            response = self.chat_session.get_response(user_input)
+            # Closing the stream when stopped early ends the request to the model
+            # The session stops before the next chunk once Stop is pressed, so what is shown
+            # matches what it records in the history
+            with contextlib.closing(self.chat_session.stream_response(user_input, stop_event=self._stop_event)) as chunks:
+                for chunk in chunks:
+                    self._queue_chunk(chunk)
             
             # Update UI (in the main thread)
-            self.root.after(0, self._update_ui_after_response, response)
+            self._call_in_ui(self._update_ui_after_response)
         except Exception as e:
-            self.root.after(0, self._update_ui_after_error, str(e))
+            self._call_in_ui(self._update_ui_after_error, str(e))
+    
+    def stop_generation(self):
+        """Stop generating the current response, the part already shown is kept"""
+        self._stop_event.set()
+        self.stop_button.config(state=tk.DISABLED)
     
-    def _update_ui_after_response(self, response):
+    def _queue_chunk(self, text):
+        """Queue streamed response text, to be shown once the UI is idle (called from the worker thread)"""
+        with self._pending_lock:
+            self._pending_chunks.append(text)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._call_in_ui(self._flush_chunks, idle=True)
+    
+    def _flush_chunks(self):
+        """Show the queued response text"""
+        with self._pending_lock:
+            text = "".join(self._pending_chunks)
+            self._pending_chunks.clear()
+            self._flush_scheduled = False
+        if text:
+            self.append_to_last_message(text)
+    
+    def _update_ui_after_response(self):
         """Update UI after response generation"""
-        # Display assistant response
-        self.append_to_history("Assistant", response)
+        # Show the rest of the response before the next one can start
+        self._flush_chunks()
         
         # Reset generation status
         self.is_generating = False
-        self.status_label.config(text="Status: Ready")
+        self.status_label.config(text=self.strings["status_ready"])
         self.send_button.config(state=tk.NORMAL)
+        self.stop_button.config(state=tk.DISABLED)
     
     def _update_ui_after_error(self, error_msg):
         """Update UI after an error occurs"""
-        messagebox.showerror("Error", f"Error generating response: {error_msg}")
+        self._flush_chunks()
+        
+        messagebox.showerror(self.strings["error"], self.strings["generate_error"].format(error=error_msg))
         
         # Reset generation status
         self.is_generating = False
-        self.status_label.config(text="Status: Error occurred")
+        self.status_label.config(text=self.strings["status_error"])
         self.send_button.config(state=tk.NORMAL)
+        self.stop_button.config(state=tk.DISABLED)
     
     def append_to_history(self, role, message):
         """Add message to chat history display area
         
         Args:
-            role: Role name, such as "User", "Assistant"
+            role: Role, such as "User", "Assistant", shown translated to the UI language
             message: Message content
         """
-        self.chat_history_text.config(state=tk.NORMAL)  # Temporarily set to editable
-        
-        # Add separator (if not the first message)
-        if self.chat_history_text.get("1.0", tk.END).strip():
-            self.chat_history_text.insert(tk.END, "\n\n")
-        
-        # Add role name
-        if role == "User":
-            self.chat_history_text.insert(tk.END, f"{role}: ", "user_tag")
-            self.chat_history_text.tag_configure("user_tag", foreground="blue", font=("TkDefaultFont", 10, "bold"))
-        elif role == "Assistant":
-            self.chat_history_text.insert(tk.END, f"{role}: ", "assistant_tag")
-            self.chat_history_text.tag_configure("assistant_tag", foreground="green", font=("TkDefaultFont", 10, "bold"))
-        else:
-            self.chat_history_text.insert(tk.END, f"{role}: ", "system_tag")
-            self.chat_history_text.tag_configure("system_tag", foreground="gray", font=("TkDefaultFont", 10, "bold"))
-        
-        # Add message content
-        self.chat_history_text.insert(tk.END, message)
+        # Add separator (if not the first message), role name and message content in one call
+        separator = "\n\n" if self._history_nonempty else ""
+        tag = self.ROLE_TAGS.get(role, "system_tag")
+        role_prefix = self._role_prefixes.get(role) or f"{role}: "
+        self.chat_history_text.insert(tk.END, separator, (), role_prefix, tag, message, ())
+        self._history_nonempty = True
+        self._trim_history()
         
         # Scroll to bottom
-        self.chat_history_text.see(tk.END)
+        self._scroll_to_end()
+    
+    def append_to_last_message(self, text):
+        """Append text to the last message in the chat history display area
         
-        self.chat_history_text.config(state=tk.DISABLED)  # Restore read-only state
+        Args:
+            text: Text to append
+        """
+        self.chat_history_text.insert(tk.END, text)
+        self._trim_history()
+        self._scroll_to_end()
+    
+    def _scroll_to_end(self):
+        """Scroll the chat history to the bottom once the UI is idle, at most once per idle cycle"""
+        if not self._see_pending:
+            self._see_pending = True
+            self.root.after_idle(self._do_scroll_to_end)
+    
+    def _do_scroll_to_end(self):
+        """Scroll the chat history to the bottom"""
+        self._see_pending = False
+        self.chat_history_text.see(tk.END)
+    
+    def _trim_history(self):
+        """Remove the oldest lines of the chat history display beyond max_history_lines"""
+        line_count = int(self.chat_history_text.index("end-1c").split(".")[0])
+        excess = line_count - self.max_history_lines
+        if excess > 0:
+            self.chat_history_text.delete("1.0", f"{excess + 1}.0")
     
     def clear_history(self):
         """Clear chat history"""
-        if messagebox.askyesno("Confirm", "Are you sure you want to clear the chat history?"):
+        if messagebox.askyesno(self.strings["confirm"], self.strings["confirm_clear"]):
             # Clear display
-            self.chat_history_text.config(state=tk.NORMAL)
             self.chat_history_text.delete("1.0", tk.END)
-            self.chat_history_text.config(state=tk.DISABLED)
+            self._history_nonempty = False
             
             # Clear session history
             self.chat_session.clear_history()
             
             # Add system message
-            self.append_to_history("System", "Chat history cleared")
+            self.append_to_history("System", self.strings["history_cleared"])
     
     def run(self):
         """Run the application"""
         self.root.mainloop()
+        
+        # Stop the response being generated and the worker thread, which no longer updates the UI
+        self._closed = True
+        self._stop_event.set()
+        self._jobs.put(None)
+        if isinstance(self.chat_session, ChatSessionProcess):
+            self.chat_session.close()